@@ -0,0 +1,286 @@
+"""Офлайн-бенчмарки горячих функций бота на синтетической истории.
+
+Пример:
+    python bench.py --users 30 --polls-per-day 8 --months 1,3,6,12 --out bench_results.json
+    python bench.py --months 6 --compare bench_results.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+import matplotlib
+matplotlib.use("Agg")
+
+import perekur2
+
+YES, NO = perekur2.ANSWER_YES, perekur2.ANSWER_NO
+
+
+class NullBot:
+    """Бот-заглушка: любой вызов Bot API ничего не делает"""
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return None
+        return call
+
+
+class NullContext:
+    def __init__(self):
+        self.bot = NullBot()
+
+
+def record_vote(t: int, user_id: int, answer: int):
+    """Записать голос так же, как это делает handle_poll_update"""
+    if answer == YES:
+        perekur2.stats_yes[user_id] += 1
+        perekur2.consecutive_yes[user_id] += 1
+        perekur2.consecutive_no[user_id] = 0
+    else:
+        perekur2.stats_no[user_id] += 1
+        perekur2.consecutive_no[user_id] += 1
+        perekur2.consecutive_yes[user_id] = 0
+    perekur2.sessions.append((t, user_id, answer))
+
+
+def reset_poll_state():
+    """Сбросить активный опрос: clear_state его не трогает, а прогоны идут друг за другом"""
+    perekur2.active_poll_id = None
+    perekur2.last_closed_poll_id = None
+    perekur2.poll_votes.clear()
+
+
+def generate_state(users: int, polls_per_day: int, months: int, seed: int = 0) -> list:
+    """Заполнить состояние бота синтетической историей. Возвращает id пользователей"""
+    rng = random.Random(seed)
+    perekur2.clear_state()
+    reset_poll_state()
+
+    user_ids = [100000 + i for i in range(users)]
+    for uid in user_ids:
+        perekur2.usernames[uid] = f"user{uid}"
+        perekur2.stats_stickers[uid] = rng.randint(0, 30)
+        perekur2.stats_photos[uid] = rng.randint(0, 30)
+
+    clock = perekur2.clock
+    today = clock.bounds()["day_start"]
+    for day_start in range(today - 30 * months * perekur2.DAY, today, perekur2.DAY):
+        if clock.weekday(day_start) < 5:
+            # Рабочий день 7:00-17:00 по местному времени
+            poll_times = sorted(
+                day_start + rng.randint(7 * 3600, 17 * 3600 - 1)
+                for _ in range(polls_per_day)
+            )
+            for t in poll_times:
+                voters = rng.sample(user_ids, k=rng.randint(1, max(1, users // 2)))
+                answers = [YES if rng.random() < 0.6 else NO for _ in voters]
+                for uid, answer in zip(voters, answers):
+                    record_vote(t, uid, answer)
+                if YES in answers:
+                    perekur2.successful_polls.append(t)
+                perekur2.record_poll_buckets(t, dict(zip(voters, answers)))
+
+    return user_ids
+
+
+def measure(func, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "repeat": repeat,
+    }
+
+
+def chart_bytes() -> dict:
+    """Суммарные байты графиков: отправленные и те же рендеры обычным PNG"""
+    sums = {"sent": 0, "png": 0}
+    for (name, _), value in perekur2.metrics_counters.items():
+        if name == "chart_sampled_bytes_total":
+            sums["sent"] += value
+        elif name == "chart_baseline_bytes_total":
+            sums["png"] += value
+    return sums
+
+
+def run_scale(args, months: int, data_dir: str) -> dict:
+    """Все замеры на одном размере истории"""
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    context = NullContext()
+
+    user_ids = generate_state(args.users, args.polls_per_day, months, args.seed)
+    top_user = max(user_ids, key=lambda uid: perekur2.stats_yes[uid])
+    voters = user_ids[: max(1, args.users // 2)]
+
+    perekur2.DATA_FILE = os.path.join(data_dir, "bot_data.json")
+    perekur2.BACKUP_FILE = os.path.join(data_dir, "bot_data_backup.json")
+    perekur2.POLL_JOURNAL_FILE = os.path.join(data_dir, "poll_journal.jsonl")
+    run(perekur2.save_data())
+    snapshot_bytes = os.path.getsize(perekur2.DATA_FILE)
+    sessions_count = len(perekur2.sessions)
+
+    def load():
+        perekur2.clear_state()
+        reset_poll_state()
+        perekur2.load_data()
+
+    async def poll_close():
+        for uid in voters:
+            await perekur2.check_achievements(uid, context, perekur2.EVENT_VOTE_YES)
+
+    cases = {
+        "save_data": (lambda: run(perekur2.save_data()), args.repeat),
+        "load_data": (load, args.repeat),
+        "rebuild_period_buckets": (perekur2.rebuild_period_buckets, args.repeat),
+        "check_achievements_poll_close": (lambda: run(poll_close()), args.repeat),
+        "get_grouped_top": (lambda: perekur2.get_grouped_top(perekur2.stats_yes, perekur2.get_smoker_level), args.repeat),
+        "create_statistics_plot": (perekur2.create_statistics_plot, args.plot_repeat),
+        "create_user_stats_plot": (lambda: perekur2.create_user_stats_plot(top_user), args.plot_repeat),
+        "show_top_text": (perekur2.build_top_text, args.repeat),
+        "friday_rewards_text": (perekur2.build_weekly_summary, args.repeat),
+        "weekly_digest_text": (perekur2.build_weekly_digest, args.repeat),
+    }
+
+    # Подготовка данных графиков: конвертация в массивы и каждая панель отдельно
+    def session_arrays():
+        perekur2.session_arrays = perekur2.empty_session_arrays()
+        perekur2.get_session_arrays()
+
+    arrays = perekur2.get_session_arrays()
+    arrays = dict(arrays, day=(arrays["t"] + perekur2.clock.offset) // perekur2.DAY)
+    cases["chart_prep.session_arrays"] = (session_arrays, args.repeat)
+    for panel, prep in perekur2.CHART_PANELS.items():
+        cases[f"chart_prep.{panel}"] = (functools.partial(prep, arrays), args.repeat)
+    cases["chart_prep.user"] = (lambda: perekur2.prepare_chart_data(top_user), args.repeat)
+
+    timings = {}
+    bytes_before = chart_bytes()
+    for name, (func, repeat) in cases.items():
+        if args.only and name not in args.only:
+            continue
+        timings[name] = measure(func, repeat)
+        print(f"  {name:<32} {timings[name]['median'] * 1000:10.2f} мс")
+
+    loop.close()
+    bytes_after = chart_bytes()
+    sent, png = (bytes_after[key] - bytes_before[key] for key in ("sent", "png"))
+    if png:
+        print(f"  {'графики к обычному PNG':<32} {sent / png:10.2f} ×")
+    return {
+        "months": months,
+        "sessions": sessions_count,
+        "snapshot_bytes": snapshot_bytes,
+        "chart_bytes": {"sent": sent, "png": png},
+        "timings": timings,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_scaling(runs: list):
+    """Таблица медиан по размерам истории"""
+    names = sorted({name for run in runs for name in run["timings"]})
+    header = f"{'функция':<32}" + "".join(f"{run['months']:>9} мес" for run in runs)
+    print("\n" + header)
+    for name in names:
+        row = f"{name:<32}"
+        for run in runs:
+            timing = run["timings"].get(name)
+            row += f"{timing['median'] * 1000:10.2f}мс" if timing else f"{'—':>12}"
+        print(row)
+
+
+def print_comparison(runs: list, baseline_path: str):
+    """Сравнение медиан с сохраненным прогоном"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    base_runs = {run["months"]: run for run in baseline["runs"]}
+
+    print(f"\nСравнение с {baseline_path} (коммит {baseline['meta'].get('commit')}):")
+    for run in runs:
+        base = base_runs.get(run["months"])
+        if base is None:
+            continue
+        print(f"{run['months']} мес:")
+        for name, timing in run["timings"].items():
+            old = base["timings"].get(name)
+            if not old:
+                continue
+            ratio = timing["median"] / old["median"] if old["median"] else float("inf")
+            print(f"  {name:<32} {old['median'] * 1000:10.2f} → {timing['median'] * 1000:10.2f} мс  ×{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки перекур-бота без Telegram")
+    parser.add_argument("--users", type=int, default=30, help="число пользователей")
+    parser.add_argument("--polls-per-day", type=int, default=8, help="опросов в рабочий день")
+    parser.add_argument("--months", default="1,3,6,12", help="размеры истории в месяцах через запятую")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов на замер")
+    parser.add_argument("--plot-repeat", type=int, default=3, help="повторов для графиков")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default="", help="замерять только перечисленные функции")
+    parser.add_argument("--out", default="bench_results.json", help="куда записать результаты JSON")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+    args.only = set(filter(None, args.only.split(",")))
+
+    perekur2.logger.setLevel(logging.WARNING)
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+    # В боте сравнение с PNG выключено (лишнее кодирование), здесь — на каждом рендере
+    perekur2.CHART_BASELINE_RATE = 1.0
+
+    runs = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for months in (int(m) for m in args.months.split(",")):
+            print(f"История {months} мес, {args.users} польз., {args.polls_per_day} опросов/день:")
+            runs.append(run_scale(args, months, data_dir))
+
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "users": args.users,
+            "polls_per_day": args.polls_per_day,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "runs": runs,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print_scaling(runs)
+    if args.compare:
+        print_comparison(runs, args.compare)
+    print(f"\nРезультаты записаны в {args.out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
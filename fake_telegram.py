@@ -0,0 +1,349 @@
+"""Фейковый Telegram Bot API для нагрузочного тестирования бота.
+
+Сервер реализует методы, которые использует бот (getUpdates, sendMessage,
+sendPoll, sendPhoto и остальные send-методы для медиа), умеет отвечать 429
+с retry_after и позволяет подкладывать апдейты: нажатия кнопки, команды,
+голоса, закрытие опросов, стикеры и фото.
+
+Отдельный запуск (бот запускается во втором терминале):
+    python fake_telegram.py --port 8081 --rate-limit 0.05
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake python perekur2.py
+"""
+import argparse
+import asyncio
+import email.policy
+import json
+import logging
+import random
+import time
+from collections import Counter
+from email.parser import BytesParser
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger("fake_telegram")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Перекур", "username": "fake_perekur_bot"}
+
+# send-метод -> поле сообщения с медиа
+MEDIA_METHODS = {
+    "sendPhoto": "photo",
+    "sendVideo": "video",
+    "sendAudio": "audio",
+    "sendDocument": "document",
+    "sendAnimation": "animation",
+    "sendSticker": "sticker",
+    "sendVoice": "voice",
+}
+
+
+def _decode_value(raw: str):
+    """Значения параметров PTB передает JSON-строками, кроме обычных строк"""
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def parse_params(content_type: str, body: bytes, query: str = "") -> dict:
+    """Разбор параметров запроса Bot API (query, urlencoded, multipart или JSON)"""
+    params = {name: _decode_value(value) for name, value in parse_qsl(query, keep_blank_values=True)}
+    if not body:
+        return params
+
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            params[name] = payload if part.get_filename() else _decode_value(payload.decode("utf-8"))
+    elif content_type.startswith("application/json"):
+        params.update(json.loads(body))
+    else:
+        params.update(
+            (name, _decode_value(value))
+            for name, value in parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+        )
+    return params
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def make_chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": "Перекур"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+
+class FakeTelegram:
+    """Состояние фейкового Bot API: очередь апдейтов, опросы и счетчики вызовов"""
+
+    def __init__(self, rate_limit: float = 0.0, retry_after: int = 1, seed: int = None):
+        self.rate_limit = rate_limit  # Доля send-вызовов, получающих 429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.next_file_id = 1
+        self.new_update = asyncio.Event()
+        self.polls = {}  # {poll_id: объект Poll}
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.uploaded_bytes = 0
+        self.expectations = []  # [(предикат, future)]
+        self.server = None
+        self.methods = {
+            "getMe": lambda params: BOT_USER,
+            "getUpdates": self.get_updates,
+            "sendMessage": self.send_message,
+            "sendPoll": self.send_poll,
+            "stopPoll": self.stop_poll,
+            "copyMessage": self.copy_message,
+            "sendMediaGroup": self.send_media_group,
+        }
+
+    # --- HTTP ---
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Фейковый Bot API слушает http://{host}:{port}/bot<token>/")
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 с keep-alive: httpx переиспользует соединения"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                url = urlsplit(target)
+                api_method = url.path.rstrip("/").rsplit("/", 1)[-1]
+                params = parse_params(headers.get("content-type", ""), body, url.query)
+                response = await self.call(api_method, params)
+
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                status = response.get("error_code", 200)
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # --- Bot API ---
+    async def call(self, method: str, params: dict) -> dict:
+        """Выполнить метод Bot API и вернуть ответ в формате Telegram"""
+        self.calls[method] += 1
+        if (method.startswith("send") or method == "copyMessage") and self.rate_limit:
+            if self.rng.random() < self.rate_limit:
+                self.rate_limited[method] += 1
+                return {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+        if method in MEDIA_METHODS:
+            result = self.send_media(MEDIA_METHODS[method], params)
+        elif method in self.methods:
+            result = self.methods[method](params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        else:
+            result = True
+
+        for predicate, future in list(self.expectations):
+            if not future.done() and predicate(method, params, result):
+                future.set_result(result)
+                self.expectations.remove((predicate, future))
+        return {"ok": True, "result": result}
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _message(self, chat_id, sender: dict = BOT_USER, **fields) -> dict:
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": make_chat(int(chat_id)),
+            "from": sender,
+            **fields,
+        }
+        self.next_message_id += 1
+        return message
+
+    def _file(self, kind: str, payload=None) -> dict:
+        """Объект файла нужного типа; загруженные байты учитываются в статистике"""
+        if isinstance(payload, bytes):
+            self.uploaded_bytes += len(payload)
+            file_id = f"{kind}-{self.next_file_id}"
+            self.next_file_id += 1
+        elif isinstance(payload, str) and not payload.startswith("attach://"):
+            file_id = payload
+        else:
+            file_id = f"{kind}-{self.next_file_id}"
+            self.next_file_id += 1
+
+        base = {"file_id": file_id, "file_unique_id": file_id}
+        if kind == "photo":
+            return [dict(base, width=1500, height=1200)]
+        if kind in ("video", "animation"):
+            return dict(base, width=640, height=480, duration=5)
+        if kind in ("audio", "voice"):
+            return dict(base, duration=5)
+        if kind == "sticker":
+            return dict(base, width=512, height=512, is_animated=False, is_video=False, type="regular")
+        return base
+
+    def send_message(self, params: dict) -> dict:
+        return self._message(params["chat_id"], text=str(params.get("text", "")))
+
+    def send_media(self, kind: str, params: dict) -> dict:
+        fields = {kind: self._file(kind, params.get(kind))}
+        if params.get("caption"):
+            fields["caption"] = str(params["caption"])
+        return self._message(params["chat_id"], **fields)
+
+    def send_media_group(self, params: dict) -> list:
+        messages = []
+        for item in params.get("media", []):
+            media = item.get("media")
+            payload = params.get(media[len("attach://"):]) if str(media).startswith("attach://") else media
+            messages.append(self.send_media(item["type"], {"chat_id": params["chat_id"], item["type"]: payload,
+                                                           "caption": item.get("caption")}))
+        return messages
+
+    def copy_message(self, params: dict) -> dict:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {"message_id": message_id}
+
+    def send_poll(self, params: dict) -> dict:
+        poll_id = str(len(self.polls) + 1)
+        poll = {
+            "id": poll_id,
+            "question": str(params.get("question", "")),
+            "options": [{"text": str(text), "voter_count": 0} for text in params.get("options", [])],
+            "total_voter_count": 0,
+            "is_closed": False,
+            "is_anonymous": bool(params.get("is_anonymous", True)),
+            "type": "regular",
+            "allows_multiple_answers": bool(params.get("allows_multiple_answers", False)),
+        }
+        if params.get("open_period"):
+            poll["open_period"] = int(params["open_period"])
+        self.polls[poll_id] = poll
+        return self._message(params["chat_id"], poll=poll)
+
+    def stop_poll(self, params: dict) -> dict:
+        for poll in self.polls.values():
+            poll["is_closed"] = True
+        return next(iter(self.polls.values()), {})
+
+    def expect(self, predicate) -> asyncio.Future:
+        """Future, который завершится на первом подходящем вызове бота"""
+        future = asyncio.get_running_loop().create_future()
+        self.expectations.append((predicate, future))
+        return future
+
+    # --- Подкладывание апдейтов ---
+    def push_update(self, **payload) -> int:
+        update = {"update_id": self.next_update_id, **payload}
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.new_update.set()
+        return update["update_id"]
+
+    def inject_text(self, user_id: int, text: str, chat_id: int = None) -> int:
+        fields = {"text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        message = self._message(chat_id or user_id, sender=make_user(user_id), **fields)
+        return self.push_update(message=message)
+
+    def inject_sticker(self, user_id: int, chat_id: int) -> int:
+        message = self._message(chat_id, sender=make_user(user_id), sticker=self._file("sticker"))
+        return self.push_update(message=message)
+
+    def inject_photo(self, user_id: int, chat_id: int) -> int:
+        message = self._message(chat_id, sender=make_user(user_id), photo=self._file("photo"))
+        return self.push_update(message=message)
+
+    def inject_poll_answer(self, poll_id: str, user_id: int, option_ids: list) -> int:
+        poll = self.polls[poll_id]
+        for option_id in option_ids:
+            poll["options"][option_id]["voter_count"] += 1
+        poll["total_voter_count"] += 1
+        return self.push_update(poll_answer={"poll_id": poll_id, "user": make_user(user_id), "option_ids": option_ids})
+
+    def inject_poll_close(self, poll_id: str) -> int:
+        poll = self.polls[poll_id]
+        poll["is_closed"] = True
+        return self.push_update(poll=dict(poll))
+
+
+async def serve(args):
+    fake = FakeTelegram(rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed)
+    await fake.start(args.host, args.port)
+    try:
+        while True:
+            await asyncio.sleep(10)
+            logger.info(f"Вызовы: {dict(fake.calls)}; 429: {dict(fake.rate_limited)}")
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля send-вызовов с ответом 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, секунды")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Нагрузочный прогон бота против фейкового Bot API.
+
+Бот запускается в этом же процессе с TELEGRAM_BASE_URL, указывающим на
+fake_telegram. Каждый раунд: нажатие «Курить 🚬» → sendPoll → голоса →
+закрытие опроса → handle_poll_update. Параллельно в группу летят стикеры
+и фото с заданной частотой.
+
+Пример:
+    python loadtest.py --rounds 50 --voters 20 --vote-rate 200 --chatter-rate 20 --rate-limit 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+
+import matplotlib
+matplotlib.use("Agg")
+
+import perekur2
+from fake_telegram import FakeTelegram
+
+YES_OPTION, NO_OPTION = 0, 1
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def wait_until(condition, timeout: float) -> bool:
+    """Ожидание состояния бота (бот работает в этом же процессе)"""
+    deadline = perf_counter() + timeout
+    while not condition():
+        if perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def chatter(fake: FakeTelegram, rate: float, user_ids: list, rng: random.Random, sent: list):
+    """Фоновый поток стикеров и фото в группе"""
+    while True:
+        user_id = rng.choice(user_ids)
+        if rng.random() < 0.5:
+            fake.inject_sticker(user_id, perekur2.GROUP_CHAT_ID)
+        else:
+            fake.inject_photo(user_id, perekur2.GROUP_CHAT_ID)
+        sent[0] += 1
+        await asyncio.sleep(1 / rate)
+
+
+async def run_round(fake: FakeTelegram, round_no: int, voters: list, args, rng: random.Random, result: dict):
+    presser = 200000 + round_no
+
+    # 1. Кнопка → sendPoll (или ответ об ошибке при 429)
+    reply = fake.expect(lambda method, params, _: method == "sendPoll"
+                        or (method == "sendMessage" and int(params["chat_id"]) == presser))
+    start = perf_counter()
+    fake.inject_text(presser, "Курить 🚬")
+    try:
+        message = await asyncio.wait_for(reply, args.timeout)
+    except asyncio.TimeoutError:
+        result["failed_rounds"] += 1
+        return
+    result["button_to_poll"].append(perf_counter() - start)
+    if "poll" not in message:
+        result["failed_rounds"] += 1
+        return
+    poll_id = message["poll"]["id"]
+    if not await wait_until(lambda: perekur2.active_poll_id == poll_id, args.timeout):
+        result["failed_rounds"] += 1
+        return
+
+    # 2. Голоса с заданной частотой
+    start = perf_counter()
+    for user_id in voters:
+        fake.inject_poll_answer(poll_id, user_id, [YES_OPTION if rng.random() < 0.6 else NO_OPTION])
+        if args.vote_rate:
+            await asyncio.sleep(1 / args.vote_rate)
+    if await wait_until(lambda: len(perekur2.poll_votes) >= len(voters), args.timeout):
+        result["votes_processed"].append(perf_counter() - start)
+
+    # 3. Закрытие опроса → handle_poll_update
+    start = perf_counter()
+    fake.inject_poll_close(poll_id)
+    if await wait_until(lambda: perekur2.active_poll_id is None, args.timeout):
+        result["poll_close"].append(perf_counter() - start)
+    else:
+        result["failed_rounds"] += 1
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    fake = FakeTelegram(rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed)
+    await fake.start(args.host, args.port)
+
+    perekur2.METRICS_PORT = 0
+    application = perekur2.build_application(
+        token="123456:FAKE", base_url=f"http://{args.host}:{args.port}/bot"
+    )
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+
+    voters = [300000 + i for i in range(args.voters)]
+    result = {"button_to_poll": [], "votes_processed": [], "poll_close": [], "failed_rounds": 0}
+    chatter_sent = [0]
+    chatter_task = None
+    if args.chatter_rate:
+        chatter_task = asyncio.create_task(chatter(fake, args.chatter_rate, voters, rng, chatter_sent))
+
+    start = perf_counter()
+    try:
+        for round_no in range(args.rounds):
+            await run_round(fake, round_no, voters, args, rng, result)
+            if args.round_interval:
+                await asyncio.sleep(args.round_interval)
+    finally:
+        elapsed = perf_counter() - start
+        if chatter_task:
+            chatter_task.cancel()
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await fake.stop()
+
+    handlers = {}
+    for (name, labels), (_, total, count) in perekur2.metrics_histograms.items():
+        if name == "handler_latency_seconds" and count:
+            handlers[dict(labels)["handler"]] = {"count": count, "avg_ms": total / count * 1000}
+
+    return {
+        "rounds": args.rounds,
+        "failed_rounds": result["failed_rounds"],
+        "elapsed_s": elapsed,
+        "rounds_per_s": args.rounds / elapsed if elapsed else 0,
+        "updates_per_s": (fake.next_update_id - 1) / elapsed if elapsed else 0,
+        "chatter_messages": chatter_sent[0],
+        "button_to_poll": percentiles(result["button_to_poll"]),
+        "votes_processed": percentiles(result["votes_processed"]),
+        "poll_close": percentiles(result["poll_close"]),
+        "handlers": handlers,
+        "api_calls": dict(fake.calls),
+        "rate_limited": dict(fake.rate_limited),
+        "uploaded_bytes": fake.uploaded_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rounds", type=int, default=20, help="число опросов")
+    parser.add_argument("--voters", type=int, default=10, help="голосующих в каждом опросе")
+    parser.add_argument("--vote-rate", type=float, default=100.0, help="голосов в секунду, 0 — без пауз")
+    parser.add_argument("--chatter-rate", type=float, default=0.0, help="стикеров и фото в секунду в группе")
+    parser.add_argument("--round-interval", type=float, default=0.0, help="пауза между опросами, секунды")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля send-вызовов с ответом 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=10.0, help="ожидание реакции бота, секунды")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="куда записать результаты JSON")
+    args = parser.parse_args()
+
+    perekur2.logger.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        perekur2.DATA_FILE = os.path.join(data_dir, "bot_data.json")
+        perekur2.BACKUP_FILE = os.path.join(data_dir, "bot_data_backup.json")
+        perekur2.POLL_JOURNAL_FILE = os.path.join(data_dir, "poll_journal.jsonl")
+        report = asyncio.run(run(args))
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
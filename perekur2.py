@@ -1,27 +1,90 @@
 import logging
 import json
 import os
-from collections import defaultdict, Counter
-from datetime import datetime, timedelta, time
+import argparse
+import asyncio
+import cProfile
+import csv
+import functools
+import hashlib
+import inspect
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
 import io
+import pstats
 import random
-import matplotlib.pyplot as plt
+import signal
+import sys
+import tempfile
+import threading
+import zipfile
+import matplotlib
+import matplotlib.style
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
 
-from telegram import Update, ReplyKeyboardMarkup, InputFile
+from telegram import Update, ReplyKeyboardMarkup, InputFile, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes,
-    MessageHandler, filters, PollAnswerHandler
+    Application, ApplicationHandlerStop, CommandHandler, ContextTypes,
+    MessageHandler, filters, PollAnswerHandler, PollHandler, TypeHandler
 )
+from telegram.request import HTTPXRequest
 
 # --- Настройки ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")  # Для фейкового Bot API
 GROUP_CHAT_ID = -1003065779971
 ADMIN_ID = 284884293
 DATA_FILE = "bot_data.json"
 BACKUP_FILE = "bot_data_backup.json"
+POLL_JOURNAL_FILE = "poll_journal.jsonl"  # Голоса активного опроса до его закрытия
+COUNTER_FLUSH_INTERVAL = 30  # Отложенная запись счетчиков стикеров/фото, секунд
+COUNTER_FLUSH_COUNT = 50  # Столько изменений — и пишем на диск, не дожидаясь интервала
+POLL_CLOSE_GRACE = 30  # Ждем закрытие опроса от Telegram столько секунд, потом закрываем сами
 POLL_DURATION = 600  # 10 минут
-COOLDOWN = timedelta(minutes=15)
+COOLDOWN = 15 * 60  # секунд
+COOLDOWNS = {  # Кулдауны по командам, секунд
+    "button": COOLDOWN,
+    "stats_detailed": 60,
+    "me": 30,
+}
+CHART_DPI = int(os.getenv("CHART_DPI", "100"))
+CHART_SCALE = float(os.getenv("CHART_SCALE", "1.0"))  # Множитель размера графиков
+CHART_FORMAT = os.getenv("CHART_FORMAT", "auto").lower()  # auto, png, webp или jpeg
+CHART_BYTE_BUDGET = int(os.getenv("CHART_BYTE_BUDGET", str(100 * 1024)))  # Желаемый размер картинки, байт
+CHART_QUALITY = int(os.getenv("CHART_QUALITY", "85"))  # Стартовое качество WebP/JPEG
+CHART_MIN_QUALITY = int(os.getenv("CHART_MIN_QUALITY", "60"))  # Ниже не опускаемся даже ради бюджета
+CHART_BASELINE_RATE = float(os.getenv("CHART_BASELINE_RATE", "0"))  # Доля рендеров с лишним кодированием в PNG для сравнения (для замеров)
+CONTENT_SEND_ATTEMPTS = 3  # Попыток на каждую отправку контента
+CONTENT_RETRY_DELAY = 2  # Пауза перед повтором, секунд (удваивается)
+CONTENT_MAX_PICKS = 3  # Сколько авторов пробуем выбрать, если запрос не доставлен
+RENDER_MAX_INFLIGHT = int(os.getenv("RENDER_MAX_INFLIGHT", "2"))  # Сколько разных графиков строится одновременно
+RENDER_USER_MAX = 1  # Сколько графиков одновременно строится для одного пользователя
+PERSIST_COOLDOWNS = os.getenv("PERSIST_COOLDOWNS", "1") == "1"  # Сохранять активные кулдауны между рестартами
+TZ_OFFSET_HOURS = int(os.getenv("TZ_OFFSET_HOURS", "5"))  # Екатеринбург (YEKT, UTC+5)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))  # 0 — эндпоинт /metrics выключен
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0"))  # Доля профилируемых вызовов, 0 — выключено
+PROFILE_THRESHOLD_MS = int(os.getenv("PROFILE_THRESHOLD_MS", "500"))  # Сохраняем только медленные вызовы
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = 50  # Сколько последних профилей хранить
+TRACE_FILE = os.getenv("TRACE_FILE")  # Запись входящих апдейтов для replay.py
+TRACE_SALT = os.getenv("TRACE_SALT") or os.urandom(8).hex()  # Соль для анонимизации id в трейсе
+LOOP_LAG_INTERVAL = 0.5  # Такт сторожа цикла событий, секунд
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))  # Дольше — считаем зависанием, 0 — сторож выключен
+LOOP_LAG_ALERT = os.getenv("LOOP_LAG_ALERT", "0") == "1"  # Сообщать админу о зависаниях
+LOOP_LAG_ALERT_COOLDOWN = 600  # Не чаще раза в столько секунд
+SHUTDOWN_DEADLINE = int(os.getenv("SHUTDOWN_DEADLINE", "8"))  # Сколько секунд ждем незавершенную работу при остановке (меньше stop timeout супервизора)
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(45 * 1024 * 1024)))  # Бот может отправить документ до 50 МБ
+EXPORT_CHUNK = 10000  # Строк сессий за одну запись при выгрузке
+WEEKLY_DIGEST_DAY = os.getenv("WEEKLY_DIGEST_DAY", "")  # День промежуточных итогов недели (0 — пн), пусто — выключено
 
 # Константы для уровней (до 1000 ответов)
 SMOKER_LEVELS = {
@@ -105,247 +168,1284 @@ logger = logging.getLogger(__name__)
 main_keyboard = [["Курить 🚬"]]
 reply_markup = ReplyKeyboardMarkup(main_keyboard, resize_keyboard=True)
 
+# --- Таблицы символов ---
+# Ответы хранятся кодами (код совпадает с номером варианта в опросе), строки — только при выводе
+ANSWER_YES, ANSWER_NO = 0, 1
+ANSWERS = ("Да, конечно", "Нет")
+ANSWER_CODES = {text: code for code, text in enumerate(ANSWERS)}
+
 # --- Хранилище ---
 active_poll_id = None
-active_poll_options = []
-poll_votes = {}  # Текущие голоса в активном опросе (только последние)
+poll_votes = {}  # Текущие голоса в активном опросе (только последние): {user_id: код ответа}
 stats_yes = defaultdict(int)
 stats_no = defaultdict(int)
 stats_stickers = defaultdict(int)
 stats_photos = defaultdict(int)
-usernames = {}
-sessions = []  # Все сессии голосований (только окончательные голоса)
-last_poll_time = None
+usernames = {}  # {user_id: текущее имя}
+username_history = defaultdict(list)  # {user_id: [[UTC epoch смены, прежнее имя], ...]}
+sessions = []  # Все сессии голосований (только окончательные голоса): (UTC epoch, user_id, код ответа)
+last_poll_time = None  # UTC epoch
+last_closed_poll_id = None  # Последний учтенный опрос (защита от повторного учета журнала)
 consecutive_yes = defaultdict(int)
 consecutive_no = defaultdict(int)
 consecutive_button_press = defaultdict(int)
-last_button_press_time = defaultdict(lambda: datetime.min)
-achievements_unlocked = defaultdict(set)
-successful_polls = []  # Успешные перекуры (опросы с хотя бы одним голосом "Да")
+achievements_unlocked = defaultdict(set)  # {user_id: {id ачивки}}
+successful_polls = []  # Успешные перекуры (опросы с хотя бы одним голосом "Да"), UTC epoch
 user_levels = defaultdict(dict)  # {user_id: {"smoker_level": int, "worker_level": int}}
+text_chart_users = set()  # Пользователи, выбравшие текстовые графики вместо картинок
 
 # --- СИСТЕМА КОНТЕНТА ДНЯ ---
-content_submissions = {}  # {user_id: {"message": message, "date": datetime}}
+content_submissions = {}  # {user_id: {"items": [элементы контента], "date": UTC epoch}}
 asked_today = set()  # Пользователи, которых уже спрашивали сегодня
 current_content_author = None  # Текущий автор контента
 
 # --- НОВАЯ ЛОГИКА НЕДЕЛЬНОГО ТОПА ---
-weekly_stats_yes = defaultdict(int)  # Статистика "Да" за текущую неделю
-weekly_stats_no = defaultdict(int)   # Статистика "Нет" за текущую неделю
-current_week_key = None  # Ключ текущей недели для автоматического сброса
-
-# --- Вспомогательные функции для графиков ---
-def setup_plot_style():
-    """Настройка стиля графиков"""
-    plt.style.use('seaborn-v0_8')
-    plt.rcParams['font.family'] = 'DejaVu Sans'
-    plt.rcParams['axes.facecolor'] = '#f8f9fa'
-    plt.rcParams['figure.facecolor'] = '#ffffff'
-
-def create_user_stats_plot(user_id):
-    """Создание персональной статистики пользователя"""
-    setup_plot_style()
-    
-    user_sessions = [(t, ans) for t, uid, ans in sessions if uid == user_id]
-    if not user_sessions:
-        return None
-    
-    fig, axes = plt.subplots(2, 2, figsize=(15, 10))
-    username = usernames.get(user_id, f"User{user_id}")
-    fig.suptitle(f'📊 Статистика пользователя: {username}', fontsize=14, fontweight='bold')
-    
-    # 1. Распределение ответов пользователя
-    user_answers = Counter(ans for _, ans in user_sessions)
-    colors = ['#28a745', '#dc3545']  # Только Да и Нет
-    axes[0, 0].pie(user_answers.values(), labels=user_answers.keys(), autopct='%1.1f%%',
-                   colors=colors[:len(user_answers)], startangle=90)
-    axes[0, 0].set_title('Мои ответы')
-    
-    # 2. Активность по дням недели
-    days = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-    day_count = [0] * 7
-    for t, _ in user_sessions:
-        day_count[t.weekday()] += 1
-    
-    axes[0, 1].bar(days, day_count, color='#007bff', alpha=0.7)
-    axes[0, 1].set_title('Мои активные дни')
-    axes[0, 1].set_ylabel('Голосов')
-    axes[0, 1].grid(True, alpha=0.3)
-    
-    # 3. Активность по рабочим часам (7:00-17:00)
-    work_periods = ['7-8', '8-9', '9-10', '10-11', '11-12', '12-13', '13-14', '14-15', '15-16', '16-17']
-    period_count = [0] * 10
-    
-    for t, _ in user_sessions:
-        hour = t.hour
-        # Только рабочие часы с 7:00 до 17:00
-        if 7 <= hour < 17:
-            period_index = hour - 7
-            period_count[period_index] += 1
-    
-    # Фильтруем только периоды с активностью
-    active_periods = []
-    active_counts = []
-    for i, count in enumerate(period_count):
-        if count > 0:
-            active_periods.append(work_periods[i])
-            active_counts.append(count)
-    
-    if active_counts:
-        axes[1, 0].bar(active_periods, active_counts, color='#20c997', alpha=0.7)
-        axes[1, 0].set_title('Активность по рабочим часам')
-        axes[1, 0].set_ylabel('Голосов')
-        axes[1, 0].grid(True, alpha=0.3)
-        plt.setp(axes[1, 0].xaxis.get_majorticklabels(), rotation=45)
-    else:
-        axes[1, 0].text(0.5, 0.5, 'Нет активности\nв рабочие часы', 
-                       ha='center', va='center', transform=axes[1, 0].transAxes)
-        axes[1, 0].set_title('Активность по рабочим часам')
-    
-    # 4. История активности (последние 7 дней)
-    today = datetime.now().date()
-    last_week = [today - timedelta(days=i) for i in range(6, -1, -1)]
-    week_dates = [d.strftime('%d.%m') for d in last_week]
-    week_count = [0] * 7
-    
-    for t, _ in user_sessions:
-        session_date = t.date()
-        for i, date_obj in enumerate(last_week):
-            if session_date == date_obj:
-                week_count[i] += 1
+week_buckets = {}  # Итоги по ISO-неделям: {"ГГГГ-НН": корзина, см. new_bucket()}
+month_buckets = {}  # Итоги по месяцам: {"ГГГГ-ММ": корзина}
+
+# --- Часы и часовой пояс ---
+DAY = 86400
+
+class Clock:
+    """Источник времени бота.
+    
+    Все отметки времени — целые секунды UTC epoch. Границы локальных суток и
+    рабочей недели считаются раз в сутки, поэтому выборки по диапазону сравнивают
+    целые числа. Функцию now можно подменить для бенчмарков и воспроизведения трейсов.
+    """
+    
+    def __init__(self, offset_hours: int = TZ_OFFSET_HOURS, now=None):
+        self.offset = offset_hours * 3600
+        self.tz = timezone(timedelta(hours=offset_hours))
+        self._now = now or (lambda: datetime.now(timezone.utc).timestamp())
+        self._bounds = None
+    
+    def now(self) -> int:
+        return int(self._now())
+    
+    def timestamp(self) -> float:
+        """Текущее время с долями секунды (лаг задач, имена профилей, трейс)"""
+        return self._now()
+    
+    def local(self, ts: int = None) -> datetime:
+        """Локальное время (aware datetime) для отображения"""
+        return datetime.fromtimestamp(self.now() if ts is None else ts, self.tz)
+    
+    def day(self, ts: int) -> int:
+        """Номер локальных суток от начала эпохи"""
+        return (ts + self.offset) // DAY
+    
+    def weekday(self, ts: int) -> int:
+        return (self.day(ts) + 3) % 7  # 01.01.1970 — четверг
+    
+    def hour(self, ts: int) -> int:
+        return (ts + self.offset) % DAY // 3600
+    
+    def bounds(self) -> dict:
+        """Границы текущих локальных суток и рабочей недели (пересчет раз в сутки)"""
+        today = self.day(self.now())
+        if self._bounds is None or self._bounds["day"] != today:
+            day_start = today * DAY - self.offset
+            week_start = day_start - self.weekday(day_start) * DAY
+            self._bounds = {
+                "day": today,
+                "day_start": day_start,
+                "day_end": day_start + DAY - 1,
+                "week_start": week_start,  # Понедельник 00:00
+                "week_end": week_start + 5 * DAY - 1,  # Пятница 23:59:59
+            }
+        return self._bounds
+
+clock = Clock()
+
+def set_clock(new_clock: Clock):
+    """Подменить часы (бенчмарки, воспроизведение трейсов)"""
+    global clock
+    clock = new_clock
+
+# --- Кулдауны ---
+class CooldownTracker:
+    """Кулдауны по командам с истекающими записями.
+    
+    Кулдаун команды фиксирован, поэтому порядок вставки совпадает с порядком
+    истечения: проверка и установка — O(1), истекшие записи снимаются с начала
+    OrderedDict, и в памяти остаются только активные.
+    """
+    
+    def __init__(self, cooldowns: dict):
+        self.cooldowns = dict(cooldowns)
+        self.entries = {command: OrderedDict() for command in self.cooldowns}  # {команда: {user_id: UTC epoch}}
+    
+    def _expire(self, command: str, now: int):
+        entries = self.entries[command]
+        limit = self.cooldowns[command]
+        while entries:
+            user_id, pressed = next(iter(entries.items()))
+            if now - pressed < limit:
                 break
+            entries.popitem(last=False)
+    
+    def remaining(self, command: str, user_id: int, now: int) -> int:
+        """Сколько секунд осталось до конца кулдауна (0 — кулдауна нет)"""
+        self._expire(command, now)
+        pressed = self.entries[command].get(user_id)
+        return 0 if pressed is None else self.cooldowns[command] - (now - pressed)
+    
+    def hit(self, command: str, user_id: int, now: int) -> int:
+        """Проверить и занять кулдаун: 0 — можно выполнять, иначе сколько секунд ждать"""
+        remaining = self.remaining(command, user_id, now)
+        if remaining > 0:
+            return remaining
+        entries = self.entries[command]
+        entries[user_id] = now
+        entries.move_to_end(user_id)
+        return 0
+    
+    def clear(self):
+        for entries in self.entries.values():
+            entries.clear()
+    
+    def to_dict(self, now: int) -> dict:
+        """Только активные записи — для сохранения"""
+        for command in self.entries:
+            self._expire(command, now)
+        return {command: {str(uid): ts for uid, ts in entries.items()} for command, entries in self.entries.items() if entries}
+    
+    def load(self, data: dict, now: int):
+        for command, entries in data.items():
+            if command not in self.entries:
+                continue
+            parsed = sorted((parse_timestamp(ts), int(uid)) for uid, ts in entries.items())
+            for ts, uid in parsed:
+                self.entries[command][uid] = ts
+            self._expire(command, now)
+    
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+cooldowns = CooldownTracker(COOLDOWNS)
+
+async def throttled(update: Update, command: str) -> bool:
+    """Ответить пользователю и вернуть True, если команда еще на кулдауне"""
+    remaining = cooldowns.hit(command, update.effective_user.id, clock.now())
+    if remaining:
+        await update.message.reply_text(f"⏳ Графики уже строились недавно, подожди еще {remaining} сек.")
+    return bool(remaining)
+
+def parse_timestamp(value) -> int:
+    """Отметка времени из снимка: число или ISO-строка старого формата (UTC)"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+# --- Метрики ---
+METRICS_PREFIX = "perekur_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+metrics_counters = defaultdict(float)  # {(имя, метки): значение}
+metrics_histograms = {}  # {(имя, метки): [счетчики по корзинам, сумма, количество]}
+metrics_gauges = {}  # {(имя, метки): функция, возвращающая текущее значение}
+metrics_last = {}  # {(имя, метки): последнее наблюдение}
+metrics_server = None
+
+def _metric_labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def inc_counter(name: str, value: float = 1, **labels):
+    metrics_counters[(name, _metric_labels(labels))] += value
+
+def observe(name: str, value: float, **labels):
+    """Записать наблюдение в гистограмму"""
+    key = (name, _metric_labels(labels))
+    hist = metrics_histograms.get(key)
+    if hist is None:
+        hist = metrics_histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+    hist[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+    hist[1] += value
+    hist[2] += 1
+    metrics_last[key] = value
+
+def register_gauge(name: str, func, **labels):
+    metrics_gauges[(name, _metric_labels(labels))] = func
+
+@contextmanager
+def timed(name: str, **labels):
+    """Замер длительности блока в гистограмму"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+def histogram_quantile(hist: list, q: float) -> float:
+    """Оценка квантиля по верхней границе корзины"""
+    buckets, _, count = hist
+    rank = q * count
+    seen = 0
+    for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+        seen += n
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+def _format_metric(name: str, labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return METRICS_PREFIX + name
+    body = ",".join(f'{k}="{v}"' for k, v in pairs)
+    return f"{METRICS_PREFIX}{name}{{{body}}}"
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    typed = set()
+    
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+    
+    for (name, labels), value in sorted(metrics_counters.items()):
+        declare(name, "counter")
+        lines.append(f"{_format_metric(name, labels)} {value:g}")
+    
+    for (name, labels), func in sorted(metrics_gauges.items(), key=lambda item: item[0]):
+        try:
+            value = func()
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить метрику {name}: {e}")
+            continue
+        declare(name, "gauge")
+        lines.append(f"{_format_metric(name, labels)} {value:g}")
+    
+    for (name, labels), (buckets, total, count) in sorted(metrics_histograms.items(), key=lambda item: item[0]):
+        declare(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f"{_format_metric(name + '_bucket', labels, (('le', le),))} {cumulative}")
+        lines.append(f"{_format_metric(name + '_sum', labels)} {total:g}")
+        lines.append(f"{_format_metric(name + '_count', labels)} {count}")
+    
+    return "\n".join(lines) + "\n"
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP-обработчик для GET /metrics"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Ошибка при отдаче метрик: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    try:
+        metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"📈 Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик: {e}")
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+# --- Сторож цикла событий ---
+running_activities = {}  # {asyncio-задача: (имя обработчика или задачи, perf_counter начала)}
+loop_watchdog = {"task": None, "thread": None, "stop": None, "beat": 0.0, "stall": None, "alerted": None}
+
+@contextmanager
+def activity(name: str):
+    """Отметить, какой обработчик или задача выполняется в текущей asyncio-задаче"""
+    task = asyncio.current_task()
+    previous = running_activities.get(task)
+    running_activities[task] = (name, perf_counter())
+    try:
+        yield
+    finally:
+        if previous is None:
+            running_activities.pop(task, None)
+        else:
+            running_activities[task] = previous
+
+def find_blocking_frame(thread_id: int) -> str:
+    """Самый глубокий вызов из кода бота в стеке потока цикла событий"""
+    frame = sys._current_frames().get(thread_id)
+    while frame is not None:
+        if frame.f_globals.get("__name__") == __name__:
+            return f"{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return "вне кода бота"
+
+def _watchdog_thread(loop, thread_id: int, stop: threading.Event):
+    """Пока цикл событий стоит, запоминаем, какой обработчик в нем выполняется и где"""
+    threshold = LOOP_LAG_THRESHOLD_MS / 1000
+    while not stop.wait(LOOP_LAG_INTERVAL / 2):
+        stalled = perf_counter() - loop_watchdog["beat"] - LOOP_LAG_INTERVAL
+        if stalled > threshold and loop_watchdog["stall"] is None:
+            name, started = running_activities.get(asyncio.current_task(loop), ("вне обработчиков", perf_counter()))
+            loop_watchdog["stall"] = {
+                "activity": name,
+                "where": find_blocking_frame(thread_id),
+                "running": perf_counter() - started,
+            }
+
+async def report_stall(bot, lag: float, stall: dict):
+    """Зависание закончилось: метрики, лог и (если включено) сообщение админу"""
+    activity_name = stall["activity"]
+    inc_counter("loop_stalls_total", activity=activity_name)
+    observe("loop_stall_seconds", lag, activity=activity_name)
+    text = (
+        f"🐢 Цикл событий завис: такт опоздал на {lag * 1000:.0f} мс. "
+        f"Выполнялся {activity_name} ({stall['where']}, уже {stall['running'] * 1000:.0f} мс)"
+    )
+    logger.warning(text)
     
-    axes[1, 1].plot(week_dates, week_count, marker='o', linewidth=2, color='#dc3545')
-    axes[1, 1].fill_between(week_dates, week_count, alpha=0.3, color='#dc3545')
-    axes[1, 1].set_title('Моя активность за неделю')
-    axes[1, 1].set_ylabel('Голосов в день')
-    axes[1, 1].grid(True, alpha=0.3)
-    plt.xticks(rotation=45)
-    
-    plt.tight_layout()
+    alerted = loop_watchdog["alerted"]
+    if LOOP_LAG_ALERT and (alerted is None or perf_counter() - alerted > LOOP_LAG_ALERT_COOLDOWN):
+        loop_watchdog["alerted"] = perf_counter()
+        try:
+            await bot.send_message(chat_id=ADMIN_ID, text=text)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить админу сообщение о зависании: {e}")
+
+async def _watchdog_heartbeat(bot):
+    """Такт сторожа: насколько позже положенного проснулся sleep"""
+    threshold = LOOP_LAG_THRESHOLD_MS / 1000
+    while True:
+        loop_watchdog["stall"] = None
+        loop_watchdog["beat"] = perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, perf_counter() - loop_watchdog["beat"] - LOOP_LAG_INTERVAL)
+        observe("loop_lag_seconds", lag)
+        if lag > threshold:
+            stall = loop_watchdog["stall"] or {"activity": "неизвестно", "where": "?", "running": lag}
+            await report_stall(bot, lag, stall)
+
+def start_loop_watchdog(bot):
+    if not LOOP_LAG_THRESHOLD_MS or loop_watchdog["task"] is not None:
+        return
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    loop_watchdog["beat"] = perf_counter()
+    loop_watchdog["stop"] = stop
+    loop_watchdog["task"] = loop.create_task(_watchdog_heartbeat(bot))
+    loop_watchdog["thread"] = threading.Thread(
+        target=_watchdog_thread, args=(loop, threading.get_ident(), stop), name="loop-watchdog", daemon=True
+    )
+    loop_watchdog["thread"].start()
+    logger.info(f"🐕 Сторож цикла событий запущен, порог {LOOP_LAG_THRESHOLD_MS} мс")
+
+async def stop_loop_watchdog():
+    task = loop_watchdog["task"]
+    if task is None:
+        return
+    loop_watchdog["stop"].set()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    loop_watchdog["task"] = None
+
+def instrument_handler(name: str, callback):
+    """Обертка обработчика с замером задержки и ошибок"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = perf_counter()
+        try:
+            with activity(name):
+                if profiling["rate"] and random.random() < profiling["rate"]:
+                    return await run_profiled(name, callback(update, context))
+                return await callback(update, context)
+        except Exception:
+            inc_counter("handler_errors_total", handler=name)
+            raise
+        finally:
+            observe("handler_latency_seconds", perf_counter() - start, handler=name)
+    return wrapper
+
+def instrument_handlers(application: Application):
+    """Обернуть все зарегистрированные обработчики замерами"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback.__name__, handler.callback)
+
+async def call_job(name: str, callback, context):
+    """Выполнить задачу с замером длительности (и профилированием, если включено)"""
+    with timed("job_duration_seconds", job=name), activity(f"задача {name}"):
+        result = callback(context)
+        if inspect.isawaitable(result):
+            if profiling["rate"] and random.random() < profiling["rate"]:
+                await run_profiled(name, result)
+            else:
+                await result
+
+def _instrument_job(name: str, callback, expected_time):
+    """Обертка задачи планировщика с замером лага и длительности"""
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        lag = max(0.0, clock.timestamp() - expected_time())
+        observe("job_lag_seconds", lag, job=name)
+        await call_job(name, callback, context)
+    return job
+
+def schedule_repeating(job_queue, callback, interval: int, first: int, name: str):
+    """run_repeating с метриками лага"""
+    schedule = {"next": clock.timestamp() + first}
+    
+    def expected_time():
+        expected = schedule["next"]
+        schedule["next"] = expected + interval
+        return expected
+    return job_queue.run_repeating(_instrument_job(name, callback, expected_time), interval=interval, first=first, name=name)
+
+# --- Ежедневные задачи ---
+SCHEDULER_MAX_SLEEP = 3600  # Проверять расписание не реже раза в час
+WORKDAYS = (0, 1, 2, 3, 4)  # Пн-Пт по местному времени
+EVERY_DAY = (0, 1, 2, 3, 4, 5, 6)
+
+daily_jobs = {}  # {имя задачи: {"callback", "hour", "minute", "days", "grace"}}
+job_runs = {}  # {имя задачи: UTC epoch последнего выполненного (или пропущенного) срока}
+
+def schedule_daily(name: str, callback, hour: int, minute: int = 0, days: tuple = EVERY_DAY, grace: int = 3600):
+    """Ежедневная задача по местному времени (дни недели: 0 — понедельник).
+    
+    Пропущенный из-за рестарта срок выполняется, если с него прошло не больше
+    grace секунд. Отметка срока попадает на диск одним сохранением с итогом
+    задачи: если бот упал до него, срок выполнится после рестарта заново, если
+    после — не повторится. Задачи, меняющие только состояние, так выполняются
+    ровно один раз; сообщения, отправленные до падения, могут уйти повторно.
+    """
+    daily_jobs[name] = {"callback": callback, "hour": hour, "minute": minute, "days": days, "grace": grace}
+
+def job_due(job: dict, now: int, forward: bool = False) -> int:
+    """Последний срок задачи не позже now (или первый срок после now)"""
+    today = clock.day(now)
+    for shift in range(8):
+        day_start = (today + shift if forward else today - shift) * DAY - clock.offset
+        due = day_start + job["hour"] * 3600 + job["minute"] * 60
+        if clock.weekday(day_start) in job["days"] and (due > now if forward else due <= now):
+            return due
+    return None
+
+async def run_due_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """Выполнить задачи, срок которых наступил, и запланировать следующую проверку"""
+    now = clock.now()
+    due_jobs = []
+    for name, job in daily_jobs.items():
+        due = job_due(job, now)
+        if due is None:
+            continue
+        if name not in job_runs:
+            # Первый запуск с этой задачей: прошлые сроки не догоняем
+            job_runs[name] = due
+        elif due > job_runs[name]:
+            due_jobs.append((due, name))
+    
+    for due, name in sorted(due_jobs):
+        job = daily_jobs[name]
+        lag = clock.now() - due
+        if lag > job["grace"]:
+            logger.warning(f"⏭️ Задача {name} пропущена: срок {clock.local(due):%d.%m %H:%M} вне окна догонки")
+            inc_counter("job_missed_total", job=name)
+            job_runs[name] = due
+            await save_data()
+            continue
+        if lag > 60:
+            logger.info(f"⏰ Догоняем задачу {name}: опоздание {lag // 60} мин")
+        observe("job_lag_seconds", lag, job=name)
+        try:
+            await call_job(name, job["callback"], context)
+        except Exception as e:
+            inc_counter("job_errors_total", job=name)
+            logger.error(f"❌ Ошибка в задаче {name}: {e}", exc_info=e)
+        # Отметка ставится после выполнения: сохранения других обработчиков во время
+        # задачи ее не запишут, на диск она попадает вместе с результатами задачи
+        job_runs[name] = due
+        await save_data()
     
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
+    now = clock.now()
+    next_due = min((job_due(job, now, forward=True) for job in daily_jobs.values()), default=now + SCHEDULER_MAX_SLEEP)
+    context.job_queue.run_once(run_due_jobs, when=max(1, min(next_due - now, SCHEDULER_MAX_SLEEP)), name="scheduler")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером исходящих вызовов Telegram"""
     
-    return buf
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            inc_counter("telegram_errors_total", method=api_method)
+            raise
+        finally:
+            observe("telegram_request_seconds", perf_counter() - start, method=api_method)
+        
+        if code == 429:
+            inc_counter("telegram_429_total", method=api_method)
+        elif code >= 400:
+            inc_counter("telegram_errors_total", method=api_method)
+        return code, payload
+
+# --- Профилирование ---
+profiling = {"rate": PROFILE_RATE, "threshold": PROFILE_THRESHOLD_MS / 1000, "active": False}
+
+async def run_profiled(name: str, awaitable):
+    """Выполнить корутину под cProfile и сохранить профиль, если она была медленной.
+    
+    Профилировщик работает на весь поток, поэтому в профиль попадают и задачи,
+    выполнявшиеся во время await. Одновременно активен только один профиль.
+    """
+    if profiling["active"]:
+        return await awaitable
+    
+    profiling["active"] = True
+    profiler = cProfile.Profile()
+    start = perf_counter()
+    profiler.enable()
+    try:
+        return await awaitable
+    finally:
+        profiler.disable()
+        profiling["active"] = False
+        elapsed = perf_counter() - start
+        if elapsed >= profiling["threshold"]:
+            save_profile(profiler, name, elapsed)
+
+def list_profiles() -> list:
+    """Сохраненные профили, от новых к старым"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    files = [f for f in os.listdir(PROFILE_DIR) if f.endswith(".prof")]
+    return [os.path.join(PROFILE_DIR, f) for f in sorted(files, reverse=True)]
 
-def create_statistics_plot():
-    """Создание общей статистики"""
-    setup_plot_style()
+def save_profile(profiler: cProfile.Profile, name: str, elapsed: float):
+    """Сохранить профиль в ротируемую директорию"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.fromtimestamp(clock.timestamp(), timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(PROFILE_DIR, f"{stamp}_{name}_{elapsed * 1000:.0f}ms.prof")
+        profiler.dump_stats(path)
+        inc_counter("profiles_saved_total", handler=name)
+        logger.info(f"🔬 Сохранен профиль медленного вызова {name}: {elapsed * 1000:.0f} мс")
+        
+        for old_path in list_profiles()[PROFILE_KEEP:]:
+            os.remove(old_path)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении профиля {name}: {e}")
+
+def top_profile_functions(paths: list, limit: int = 15) -> list:
+    """Топ функций по суммарному времени в наборе профилей"""
+    stats = pstats.Stats(*paths, stream=io.StringIO())
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    result = []
+    for (filename, line, func), (_, calls, own_time, cum_time, _) in rows[:limit]:
+        location = f"{os.path.basename(filename)}:{line}" if line else filename
+        result.append((func, location, calls, own_time, cum_time))
+    return result
+
+# --- Запись трейсов апдейтов ---
+trace_handle = None
+
+def anonymize_id(user_id: int) -> int:
+    """Стабильный в пределах трейса анонимный id"""
+    digest = hashlib.sha256(f"{TRACE_SALT}:{user_id}".encode()).digest()
+    return int.from_bytes(digest[:6], "big")
+
+def trace_event(update: Update):
+    """Компактная запись апдейта без текстов сообщений и с анонимными id"""
+    if update.poll_answer:
+        return {
+            "k": "answer",
+            "p": update.poll_answer.poll_id,
+            "o": list(update.poll_answer.option_ids),
+            "u": anonymize_id(update.poll_answer.user.id),
+        }
+    if update.poll:
+        return {"k": "close", "p": update.poll.id} if update.poll.is_closed else None
     
-    if not sessions:
+    message = update.message
+    if message is None or update.effective_user is None:
         return None
     
-    fig, axes = plt.subplots(2, 2, figsize=(15, 12))
-    fig.suptitle('📊 Статистика перекуров', fontsize=16, fontweight='bold')
+    event = {"u": anonymize_id(update.effective_user.id), "c": "g" if message.chat.id == GROUP_CHAT_ID else "p"}
+    if message.sticker:
+        event["k"] = "sticker"
+    elif message.photo:
+        event["k"] = "photo"
+    elif message.text == "Курить 🚬":
+        event["k"] = "button"
+    elif message.text and message.text.startswith("/"):
+        event["k"] = "command"
+        event["x"] = message.text
+    else:
+        return None
+    return event
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Дописать апдейт в трейс (обработчик в группе -1, ничего не блокирует)"""
+    global trace_handle
+    event = trace_event(update)
+    if event is None:
+        return
     
-    # 1. Распределение ответов
-    answers_count = {
-        'Да, конечно': sum(1 for _, _, ans in sessions if ans == "Да, конечно"),
-        'Нет': sum(1 for _, _, ans in sessions if ans == "Нет")
+    event["t"] = round(clock.timestamp(), 3)
+    try:
+        if trace_handle is None:
+            trace_handle = open(TRACE_FILE, "a", encoding="utf-8", buffering=1)
+        trace_handle.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+    except Exception as e:
+        logger.error(f"Ошибка при записи трейса: {e}")
+
+register_gauge("sessions", lambda: len(sessions))
+register_gauge("successful_polls", lambda: len(successful_polls))
+for _name, _dict in (
+    ("stats_yes", stats_yes), ("stats_no", stats_no),
+    ("stats_stickers", stats_stickers), ("stats_photos", stats_photos),
+    ("usernames", usernames), ("achievements_unlocked", achievements_unlocked),
+    ("user_levels", user_levels),
+):
+    register_gauge("state_entries", functools.partial(len, _dict), dict=_name)
+register_gauge("cooldown_entries", lambda: len(cooldowns))
+
+# --- Подготовка данных для графиков ---
+WEEKDAYS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+WORK_PERIODS = ['7-8', '8-9', '9-10', '10-11', '11-12', '12-13', '13-14', '14-15', '15-16', '16-17']
+
+def empty_session_arrays() -> dict:
+    return {"count": 0, "t": np.empty(0, np.int64), "uid": np.empty(0, np.int64), "yes": np.empty(0, bool)}
+
+session_arrays = empty_session_arrays()
+
+def get_session_arrays() -> dict:
+    """Сессии в виде массивов NumPy. Список сессий только дописывается, поэтому
+    конвертируем лишь новые записи (безопасно вызывать из потока рендеринга)"""
+    global session_arrays
+    cached = session_arrays
+    count = len(sessions)
+    if count == cached["count"]:
+        return cached
+    if count < cached["count"]:
+        cached = empty_session_arrays()
+    
+    t, uid, ans = zip(*sessions[cached["count"]:count])
+    session_arrays = {
+        "count": count,
+        "t": np.concatenate((cached["t"], np.array(t, dtype=np.int64))),
+        "uid": np.concatenate((cached["uid"], np.array(uid, dtype=np.int64))),
+        "yes": np.concatenate((cached["yes"], np.array(ans) == ANSWER_YES)),
     }
-    
-    colors = ['#28a745', '#dc3545']  # Только Да и Нет
-    axes[0, 0].pie(answers_count.values(), labels=answers_count.keys(), autopct='%1.1f%%', 
-                   colors=colors, startangle=90)
-    axes[0, 0].set_title('📈 Распределение ответов')
-    
-    # 2. Активность по дням недели
-    days = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-    day_count = [0] * 7
-    for t, _, _ in sessions:
-        day_count[t.weekday()] += 1
-    
-    axes[0, 1].bar(days, day_count, color='#007bff', alpha=0.7)
-    axes[0, 1].set_title('📅 Активность по дням недели')
-    axes[0, 1].set_ylabel('Количество голосов')
-    axes[0, 1].grid(True, alpha=0.3)
-    
-    # 3. Активность по рабочим часам (7:00-17:00)
-    work_periods = ['7-8', '8-9', '9-10', '10-11', '11-12', '12-13', '13-14', '14-15', '15-16', '16-17']
-    period_count = [0] * 10
-    
-    for t, _, _ in sessions:
-        hour = t.hour
-        # Только рабочие часы с 7:00 до 17:00
-        if 7 <= hour < 17:
-            period_index = hour - 7
-            period_count[period_index] += 1
-    
-    # Фильтруем только периоды с активностью
-    active_periods = []
-    active_counts = []
-    for i, count in enumerate(period_count):
-        if count > 0:
-            active_periods.append(work_periods[i])
-            active_counts.append(count)
-    
-    if active_counts:
-        axes[1, 0].bar(active_periods, active_counts, color='#20c997', alpha=0.7)
-        axes[1, 0].set_title('🕐 Активность по рабочим часам')
-        axes[1, 0].set_xlabel('Часовые промежутки')
-        axes[1, 0].set_ylabel('Количество голосов')
-        axes[1, 0].grid(True, alpha=0.3)
-        plt.setp(axes[1, 0].xaxis.get_majorticklabels(), rotation=45)
-    else:
-        axes[1, 0].text(0.5, 0.5, 'Нет активности\nв рабочие часы', 
-                       ha='center', va='center', transform=axes[1, 0].transAxes)
-        axes[1, 0].set_title('🕐 Активность по рабочим часам')
-    
-    # 4. Топ пользователей
-    user_yes = defaultdict(int)
-    for _, uid, ans in sessions:
-        if ans == "Да, конечно":
-            user_yes[uid] += 1
-    
-    if user_yes:
-        top_users = sorted(user_yes.items(), key=lambda x: x[1], reverse=True)[:8]
-        user_names = [usernames.get(uid, f"User{uid}")[:15] for uid, _ in top_users]
-        user_counts = [count for _, count in top_users]
+    return session_arrays
+
+def _panel_answers(arrays: dict) -> dict:
+    yes_count = int(arrays["yes"].sum())
+    return {ANSWERS[ANSWER_YES]: yes_count, ANSWERS[ANSWER_NO]: len(arrays["yes"]) - yes_count}
+
+def _panel_weekdays(arrays: dict) -> np.ndarray:
+    return np.bincount((arrays["day"] + 3) % 7, minlength=7)
+
+def _panel_work_hours(arrays: dict) -> np.ndarray:
+    """Голоса по рабочим часам 7:00-17:00"""
+    hours = (arrays["t"] + clock.offset) % DAY // 3600
+    hours = hours[(hours >= 7) & (hours < 17)]
+    return np.bincount(hours - 7, minlength=10)
+
+def _panel_last_week(arrays: dict) -> np.ndarray:
+    """Голоса за последние 7 дней, от старых к сегодняшнему"""
+    days_ago = clock.bounds()["day"] - arrays["day"]
+    days_ago = days_ago[(days_ago >= 0) & (days_ago < 7)]
+    return np.bincount(6 - days_ago, minlength=7)
+
+def _panel_top_users(arrays: dict, limit: int = 8) -> list:
+    """Топ по ответам «Да»: [(user_id, count)]"""
+    uids, counts = np.unique(arrays["uid"][arrays["yes"]], return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:limit]
+    return [(int(uids[i]), int(counts[i])) for i in order]
+
+CHART_PANELS = {
+    "answers": _panel_answers,
+    "weekdays": _panel_weekdays,
+    "work_hours": _panel_work_hours,
+    "last_week": _panel_last_week,
+    "top_users": _panel_top_users,
+}
+
+def prepare_chart_data(user_id: int = None, panels=CHART_PANELS) -> dict:
+    """Серии для всех панелей графика за один проход по массивам сессий"""
+    arrays = get_session_arrays()
+    if user_id is not None:
+        mask = arrays["uid"] == user_id
+        arrays = {"t": arrays["t"][mask], "uid": arrays["uid"][mask], "yes": arrays["yes"][mask]}
+    arrays = dict(arrays, day=(arrays["t"] + clock.offset) // DAY)
+    data = {"total": len(arrays["t"])}
+    for name in panels:
+        data[name] = CHART_PANELS[name](arrays)
+    return data
+
+# --- Вспомогательные функции для графиков ---
+CHART_STYLE = ['seaborn-v0_8', {
+    'font.family': 'DejaVu Sans',
+    'axes.facecolor': '#f8f9fa',
+    'figure.facecolor': '#ffffff',
+}]
+CHART_SIZES = {"user": (15, 10), "statistics": (15, 12)}  # дюймы при CHART_SCALE = 1
+CHART_TITLES = {
+    "user": {
+        "answers": 'Мои ответы',
+        "weekdays": 'Мои активные дни',
+        "work_hours": 'Активность по рабочим часам',
+        "last_week": 'Моя активность за неделю',
+        "ylabel": 'Голосов',
+    },
+    "statistics": {
+        "answers": '📈 Распределение ответов',
+        "weekdays": '📅 Активность по дням недели',
+        "work_hours": '🕐 Активность по рабочим часам',
+        "top_users": '🏆 Топ курильщиков',
+        "ylabel": 'Количество голосов',
+    },
+}
+CHART_KIND_PANELS = {  # Панели каждого вида графика
+    "user": ("answers", "weekdays", "work_hours", "last_week"),
+    "statistics": ("answers", "weekdays", "work_hours", "top_users"),
+}
+TOP_CHART_USERS = 8
+
+chart_templates = threading.local()  # Шаблоны графиков — свои в каждом потоке рендеринга
+
+class ChartTemplate:
+    """Фигура 2x2 с готовыми осями, подписями и разметкой.
+    
+    Разметка (tight_layout) считается один раз при создании; на каждый запрос
+    меняются только данные артистов: высоты столбцов, сектора, линия, подписи.
+    """
+    
+    def __init__(self, kind: str):
+        self.kind = kind
+        titles = CHART_TITLES[kind]
+        width, height = CHART_SIZES[kind]
+        with matplotlib.style.context(CHART_STYLE):
+            self.fig = Figure(figsize=(width * CHART_SCALE, height * CHART_SCALE), dpi=CHART_DPI)
+            FigureCanvasAgg(self.fig)
+            axes = self.fig.subplots(2, 2)
+            if kind == "user":
+                self.suptitle = self.fig.suptitle('📊 Статистика пользователя: ', fontsize=14, fontweight='bold')
+            else:
+                self.suptitle = self.fig.suptitle('📊 Статистика перекуров', fontsize=16, fontweight='bold')
+            
+            # 1. Распределение ответов
+            self.pie_axes = axes[0, 0]
+            self.wedges, self.pie_labels, self.pie_pcts = axes[0, 0].pie(
+                [1, 1], labels=list(ANSWERS), autopct='%1.1f%%',
+                colors=['#28a745', '#dc3545'], startangle=90
+            )
+            axes[0, 0].set_title(titles["answers"])
+            
+            # 2. Активность по дням недели
+            self.day_axes = axes[0, 1]
+            self.day_bars = axes[0, 1].bar(WEEKDAYS, [0] * 7, color='#007bff', alpha=0.7)
+            axes[0, 1].set_title(titles["weekdays"])
+            axes[0, 1].set_ylabel(titles["ylabel"])
+            axes[0, 1].grid(True, alpha=0.3)
+            
+            # 3. Активность по рабочим часам (7:00-17:00)
+            self.hour_axes = axes[1, 0]
+            self.hour_bars = axes[1, 0].bar(WORK_PERIODS, [0] * 10, color='#20c997', alpha=0.7)
+            self.no_activity = axes[1, 0].text(0.5, 0.5, 'Нет активности\nв рабочие часы',
+                                               ha='center', va='center', transform=axes[1, 0].transAxes)
+            axes[1, 0].set_title(titles["work_hours"])
+            if kind == "statistics":
+                axes[1, 0].set_xlabel('Часовые промежутки')
+            axes[1, 0].set_ylabel(titles["ylabel"])
+            axes[1, 0].grid(True, alpha=0.3)
+            axes[1, 0].tick_params(axis='x', labelrotation=45)
+            
+            # 4. Последние 7 дней у пользователя, топ курильщиков в общей статистике
+            self.last_axes = axes[1, 1]
+            if kind == "user":
+                x = np.arange(7)
+                self.week_line, = axes[1, 1].plot(x, [0] * 7, marker='o', linewidth=2, color='#dc3545')
+                self.week_fill = axes[1, 1].fill_between(x, [0] * 7, alpha=0.3, color='#dc3545')
+                axes[1, 1].set_xticks(x, ['00.00'] * 7)
+                axes[1, 1].set_title(titles["last_week"])
+                axes[1, 1].set_ylabel('Голосов в день')
+                axes[1, 1].grid(True, alpha=0.3)
+                axes[1, 1].tick_params(axis='x', labelrotation=45)
+            else:
+                y_pos = np.arange(TOP_CHART_USERS)
+                self.top_bars = axes[1, 1].barh(y_pos, [0] * TOP_CHART_USERS, color='#fd7e14', alpha=0.7)
+                axes[1, 1].set_yticks(y_pos, ['W' * 15] * TOP_CHART_USERS)  # Место под самые длинные имена
+                axes[1, 1].set_title(titles["top_users"])
+                axes[1, 1].set_xlabel('Количество "Да"')
+            
+            self.fig.tight_layout()
+    
+    def update_answers(self, answers: dict):
+        total = sum(answers.values())
+        theta = 90
+        for wedge, label, pct, count in zip(self.wedges, self.pie_labels, self.pie_pcts, answers.values()):
+            for artist in (wedge, label, pct):
+                artist.set_visible(count > 0)
+            if not count:
+                continue
+            span = 360 * count / total
+            wedge.set_theta1(theta)
+            wedge.set_theta2(theta + span)
+            middle = np.deg2rad(theta + span / 2)
+            x, y = np.cos(middle), np.sin(middle)
+            label.set_position((1.1 * x, 1.1 * y))
+            label.set_horizontalalignment('left' if x > 0 else 'right')
+            pct.set_position((0.6 * x, 0.6 * y))
+            pct.set_text(f'{100 * count / total:.1f}%')
+            theta += span
+    
+    @staticmethod
+    def update_bars(axes, bars, values, horizontal: bool = False):
+        for bar, value in zip(bars, values):
+            if horizontal:
+                bar.set_width(value)
+            else:
+                bar.set_height(value)
+        limit = max(1, max(values, default=0)) * 1.05
+        if horizontal:
+            axes.set_xlim(0, limit)
+        else:
+            axes.set_ylim(0, limit)
+    
+    def update(self, data: dict, title: str = None):
+        if title:
+            self.suptitle.set_text(title)
+        self.update_answers(data["answers"])
+        self.update_bars(self.day_axes, self.day_bars, data["weekdays"])
+        self.update_bars(self.hour_axes, self.hour_bars, data["work_hours"])
+        self.no_activity.set_visible(not data["work_hours"].any())
         
-        y_pos = np.arange(len(user_names))
-        axes[1, 1].barh(y_pos, user_counts, color='#fd7e14', alpha=0.7)
-        axes[1, 1].set_yticks(y_pos)
-        axes[1, 1].set_yticklabels(user_names)
-        axes[1, 1].set_title('🏆 Топ курильщиков')
-        axes[1, 1].set_xlabel('Количество "Да"')
+        if "last_week" in data:
+            day_start = clock.bounds()["day_start"]
+            week_dates = [clock.local(day_start - i * DAY).strftime('%d.%m') for i in range(6, -1, -1)]
+            week_count = data["last_week"]
+            x = np.arange(7)
+            self.week_line.set_ydata(week_count)
+            self.week_fill.remove()
+            self.week_fill = self.last_axes.fill_between(x, week_count, alpha=0.3, color='#dc3545')
+            self.last_axes.set_xticks(x, week_dates)
+            self.last_axes.set_ylim(0, max(1, week_count.max()) * 1.1)
+        
+        if "top_users" in data:
+            top_users = data["top_users"]
+            counts = [count for _, count in top_users] + [0] * (TOP_CHART_USERS - len(top_users))
+            names = [usernames.get(uid, f"User{uid}")[:15] for uid, _ in top_users]
+            self.update_bars(self.last_axes, self.top_bars, counts, horizontal=True)
+            self.last_axes.set_yticks(np.arange(TOP_CHART_USERS), names + [''] * (TOP_CHART_USERS - len(names)))
+    
+    def render(self) -> io.BytesIO:
+        """Отрисовать фигуру и сжать картинку"""
+        canvas = self.fig.canvas
+        canvas.draw()
+        image = Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+        return io.BytesIO(compress_chart(image.convert("RGB"), self.kind))
+
+# --- Сжатие картинок ---
+IMAGE_EXTENSIONS = {b"\x89PNG": "png", b"RIFF": "webp", b"\xff\xd8\xff": "jpg"}
+
+def encode_image(image, fmt: str, quality: int = None) -> bytes:
+    buf = io.BytesIO()
+    if fmt == "png":
+        # У графиков мало цветов: палитра из 256 почти без потерь и в разы меньше
+        image.quantize(256, method=Image.Quantize.FASTOCTREE).save(buf, format="PNG", optimize=True)
+    elif fmt == "webp":
+        image.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+def encode_ladder():
+    """Варианты кодирования от лучшего качества к худшему"""
+    formats = ("webp", "jpeg") if CHART_FORMAT == "auto" else (CHART_FORMAT,)
+    if "png" in formats or CHART_FORMAT == "auto":
+        yield "png", None
+    for quality in range(CHART_QUALITY, CHART_MIN_QUALITY - 1, -10):
+        for fmt in formats:
+            if fmt != "png":
+                yield fmt, quality
+
+def compress_chart(image, chart: str) -> bytes:
+    """Самый маленький вариант из опробованных; перебор останавливается на первом,
+    уложившемся в CHART_BYTE_BUDGET, качество не ниже CHART_MIN_QUALITY"""
+    best = None
+    for fmt, quality in encode_ladder():
+        start = perf_counter()
+        data = encode_image(image, fmt, quality)
+        observe("chart_encode_seconds", perf_counter() - start, format=fmt)
+        if best is None or len(data) < len(best):
+            best, best_format = data, fmt
+        if len(data) <= CHART_BYTE_BUDGET:
+            break
     
-    plt.tight_layout()
+    inc_counter("chart_bytes_total", len(best), chart=chart, format=best_format)
+    if random.random() < CHART_BASELINE_RATE:
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        inc_counter("chart_baseline_bytes_total", len(buf.getvalue()), chart=chart)
+        inc_counter("chart_sampled_bytes_total", len(best), chart=chart)
+    return best
+
+def image_extension(data: bytes) -> str:
+    for magic, extension in IMAGE_EXTENSIONS.items():
+        if data.startswith(magic):
+            return extension
+    return "png"
+
+def get_chart_template(kind: str) -> ChartTemplate:
+    """Шаблон графика текущего потока (создается при первом рендере)"""
+    template = getattr(chart_templates, kind, None)
+    if template is None:
+        template = ChartTemplate(kind)
+        setattr(chart_templates, kind, template)
+    return template
+
+def create_user_stats_plot(user_id):
+    """Создание персональной статистики пользователя"""
+    data = prepare_chart_data(user_id, CHART_KIND_PANELS["user"])
+    if not data["total"]:
+        return None
     
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
+    username = usernames.get(user_id, f"User{user_id}")
+    chart = get_chart_template("user")
+    chart.update(data, f'📊 Статистика пользователя: {username}')
+    return chart.render()
+
+def create_statistics_plot():
+    """Создание общей статистики"""
+    data = prepare_chart_data(None, CHART_KIND_PANELS["statistics"])
+    if not data["total"]:
+        return None
     
-    return buf
+    chart = get_chart_template("statistics")
+    chart.update(data)
+    return chart.render()
+
+# --- Текстовые графики ---
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+BAR_EIGHTHS = "▏▎▍▌▋▊▉"
+TEXT_BAR_WIDTH = 12  # Символов на самую длинную полосу
+TEXT_CHART_ARGS = {"text", "текст"}
+IMAGE_CHART_ARGS = {"image", "картинка"}
+
+def text_bar(value: int, peak: int) -> str:
+    """Горизонтальная полоса с точностью до 1/8 символа, дополненная до общей ширины"""
+    full, rest = divmod(round(value / peak * TEXT_BAR_WIDTH * 8) if peak else 0, 8)
+    bar = "█" * full + (BAR_EIGHTHS[rest - 1] if rest else "")
+    return bar.ljust(TEXT_BAR_WIDTH)
+
+def sparkline(values) -> str:
+    peak = max(values)
+    return "".join(SPARK_BLOCKS[round(value / peak * 7)] if peak else SPARK_BLOCKS[0] for value in values)
+
+def text_bar_rows(labels: list, values: list, suffixes: list = None) -> str:
+    peak = max(values, default=0)
+    width = max(map(len, labels), default=0)
+    suffixes = suffixes or [""] * len(values)
+    return "\n".join(
+        f"{label:<{width}} {text_bar(value, peak)} {value}{suffix}"
+        for label, value, suffix in zip(labels, values, suffixes)
+    )
+
+def _text_answers(data: dict) -> str:
+    counts = list(data["answers"].values())
+    total = sum(counts) or 1
+    return text_bar_rows(list(data["answers"]), counts, [f" ({count / total:.0%})" for count in counts])
+
+def _text_weekdays(data: dict) -> str:
+    return text_bar_rows(WEEKDAYS, data["weekdays"].tolist())
+
+def _text_work_hours(data: dict) -> str:
+    hours = data["work_hours"]
+    if not hours.any():
+        return "Нет активности в рабочие часы"
+    peak = int(hours.argmax())
+    return f"7 {sparkline(hours.tolist())} 17\nпик {WORK_PERIODS[peak]}: {int(hours[peak])} голосов"
+
+def _text_last_week(data: dict) -> str:
+    days = data["last_week"].tolist()
+    day_start = clock.bounds()["day_start"]
+    first = clock.local(day_start - 6 * DAY).strftime('%d.%m')
+    return f"{first} {sparkline(days)} сегодня\nза неделю {sum(days)}, сегодня {days[-1]}"
+
+def _text_top_users(data: dict) -> str:
+    if not data["top_users"]:
+        return "Пока никто не курил"
+    names = [usernames.get(uid, f"User{uid}")[:15].replace("`", "'") for uid, _ in data["top_users"]]
+    return text_bar_rows(names, [count for _, count in data["top_users"]])
+
+TEXT_PANELS = {
+    "answers": _text_answers,
+    "weekdays": _text_weekdays,
+    "work_hours": _text_work_hours,
+    "last_week": _text_last_week,
+    "top_users": _text_top_users,
+}
+
+def create_text_chart(kind: str, user_id: int = None):
+    """Все панели графика моноширинным текстом для Markdown — без matplotlib и загрузки картинки"""
+    with timed("chart_text_seconds", chart=kind):
+        data = prepare_chart_data(user_id, CHART_KIND_PANELS[kind])
+        if not data["total"]:
+            return None
+        titles = CHART_TITLES[kind]
+        blocks = [f"{titles[panel]}\n{TEXT_PANELS[panel](data)}" for panel in CHART_KIND_PANELS[kind]]
+    return "```\n" + "\n\n".join(blocks) + "\n```"
+
+def wants_text_chart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Текстовый режим: аргумент команды важнее сохраненной настройки пользователя"""
+    arg = context.args[0].lower() if context.args else ""
+    if arg in TEXT_CHART_ARGS:
+        return True
+    if arg in IMAGE_CHART_ARGS:
+        return False
+    return update.effective_user.id in text_chart_users
+
+# --- Пул рендеринга графиков ---
+# Рендер идет вне event loop; шаблоны графиков у каждого потока свои.
+render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+render_inflight = {}  # {ключ графика: asyncio.Future с картинкой}
+render_user_inflight = defaultdict(int)  # {user_id: сколько его графиков строится}
+render_cache = {}  # {ключ графика: (версия данных, картинка)} — последний построенный вариант
+
+register_gauge("render_inflight", lambda: len(render_inflight))
+
+def chart_version():
+    """Версия данных для графиков: меняется с новыми голосами и с наступлением нового дня"""
+    return (len(sessions), clock.bounds()["day"])
+
+def _render(chart: str, func, args):
+    """Выполняется в потоке пула рендеринга"""
+    with timed("chart_render_seconds", chart=chart):
+        buf = func(*args)
+    return buf.getvalue() if buf else None
+
+def _render_done(key, user_id: int, version, future):
+    render_inflight.pop(key, None)
+    render_user_inflight[user_id] -= 1
+    if render_user_inflight[user_id] <= 0:
+        del render_user_inflight[user_id]
+    if not future.cancelled() and future.exception() is None and future.result():
+        render_cache[key] = (version, future.result())
+
+async def render_chart(key: tuple, user_id: int, func, *args):
+    """Построить график с объединением одинаковых запросов и лимитами.
+    
+    Возвращает (картинка, источник), источник: "render" — построен заново,
+    "shared" — дождались чужого такого же рендера, "cache" — данные не менялись,
+    "stale" — лимит превышен, отдаем прошлый вариант. (None, "busy") — лимит
+    превышен и отдать нечего.
+    """
+    chart = key[0]
+    version = chart_version()
+    cached = render_cache.get(key)
+    if cached and cached[0] == version:
+        inc_counter("chart_requests_total", chart=chart, result="cache")
+        return cached[1], "cache"
+    
+    future = render_inflight.get(key)
+    if future is not None:
+        inc_counter("chart_requests_total", chart=chart, result="shared")
+        return await asyncio.shield(future), "shared"
+    
+    if render_user_inflight[user_id] >= RENDER_USER_MAX or len(render_inflight) >= RENDER_MAX_INFLIGHT:
+        if cached:
+            inc_counter("chart_requests_total", chart=chart, result="stale")
+            return cached[1], "stale"
+        inc_counter("chart_requests_total", chart=chart, result="busy")
+        return None, "busy"
+    
+    inc_counter("chart_requests_total", chart=chart, result="render")
+    future = asyncio.get_running_loop().run_in_executor(render_pool, _render, chart, func, args)
+    render_inflight[key] = future
+    render_user_inflight[user_id] += 1
+    future.add_done_callback(functools.partial(_render_done, key, user_id, version))
+    return await asyncio.shield(future), "render"
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ НЕДЕЛЬНОГО ТОПА ---
 def get_current_week_range():
-    """Вычисляет диапазон текущей рабочей недели (понедельник 00:00 - пятница 23:59)"""
-    # Используем екатеринбургское время
-    now_ekt = datetime.utcnow() + timedelta(hours=5)
-    
-    # Находим понедельник текущей недели
-    monday = now_ekt - timedelta(days=now_ekt.weekday())
-    monday = monday.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # Находим пятницу текущей недели
-    friday = monday + timedelta(days=4)
-    friday = friday.replace(hour=23, minute=59, second=59, microsecond=999999)
-    
-    return monday, friday
+    """Диапазон текущей рабочей недели (понедельник 00:00 - пятница 23:59) в UTC epoch"""
+    bounds = clock.bounds()
+    return bounds["week_start"], bounds["week_end"]
 
 def get_week_range_display():
     """Возвращает строку с диапазоном недели в формате 'дд.мм - дд.мм'"""
     monday, friday = get_current_week_range()
-    return f"{monday.strftime('%d.%m')} - {friday.strftime('%d.%m')}"
+    return f"{clock.local(monday).strftime('%d.%m')} - {clock.local(friday).strftime('%d.%m')}"
+
+def week_key(t: int) -> str:
+    """Ключ ISO-недели момента t в формате ГГГГ-НН"""
+    return clock.local(t).strftime('%G-%V')
+
+def month_key(t: int) -> str:
+    """Ключ месяца момента t в формате ГГГГ-ММ"""
+    return clock.local(t).strftime('%Y-%m')
 
 def get_current_week_key():
-    """Возвращает ключ для текущей недели в формате ГГГГ-НЕДЕЛЯ"""
-    monday, _ = get_current_week_range()
-    return monday.strftime('%Y-%W')
+    """Возвращает ключ для текущей недели в формате ГГГГ-НН"""
+    return week_key(clock.now())
+
+def new_bucket() -> dict:
+    """Корзина итогов периода: опросы, перекуры, голоса и ответы по пользователям"""
+    return {"polls": 0, "successful": 0, "votes": 0, "yes": defaultdict(int), "no": defaultdict(int)}
+
+def current_week() -> dict:
+    """Корзина текущей недели (пустая, если опросов еще не было)"""
+    return week_buckets.get(get_current_week_key()) or new_bucket()
+
+def add_to_bucket(bucket: dict, votes: dict):
+    """Учесть в корзине закрытый опрос с окончательными голосами {user_id: код ответа}"""
+    yes_votes = 0
+    for user_id, answer in votes.items():
+        if answer == ANSWER_YES:
+            bucket["yes"][user_id] += 1
+            yes_votes += 1
+        elif answer == ANSWER_NO:
+            bucket["no"][user_id] += 1
+    bucket["polls"] += 1
+    bucket["votes"] += len(votes)
+    if yes_votes:
+        bucket["successful"] += 1
+
+def record_poll_buckets(t: int, votes: dict):
+    """Обновить итоги периодов при закрытии опроса — без пересчета истории"""
+    for buckets, key_func, _ in PERIODS.values():
+        key = key_func(t)
+        if key not in buckets:
+            buckets[key] = new_bucket()
+        add_to_bucket(buckets[key], votes)
+
+def rebuild_period_buckets():
+    """Пересобрать корзины по истории сессий (данные старого формата)"""
+    for buckets, _, _ in PERIODS.values():
+        buckets.clear()
+    polls = defaultdict(dict)
+    for t, uid, ans in sessions:
+        polls[t][uid] = ans
+    for t in successful_polls:
+        polls.setdefault(t, {})
+    for t in sorted(polls):
+        record_poll_buckets(t, polls[t])
+
+def parse_week_key(key: str) -> datetime:
+    """Понедельник ISO-недели по ключу ГГГГ-НН (ValueError, если ключ неверный)"""
+    return datetime.strptime(f"{key}-1", "%G-%V-%u")
+
+def parse_month_key(key: str) -> datetime:
+    """Первое число месяца по ключу ГГГГ-ММ (ValueError, если ключ неверный)"""
+    return datetime.strptime(key, "%Y-%m")
+
+# {период: (корзины, ключ момента времени, разбор ключа)}
+PERIODS = {
+    "week": (week_buckets, week_key, parse_week_key),
+    "month": (month_buckets, month_key, parse_month_key),
+}
+
+def bucket_to_json(bucket: dict) -> dict:
+    return dict(bucket, yes=dict(bucket["yes"]), no=dict(bucket["no"]))
+
+def bucket_from_json(data: dict) -> dict:
+    bucket = new_bucket()
+    bucket.update(data)
+    bucket["yes"] = defaultdict(int, int_keys(data.get("yes", {})))
+    bucket["no"] = defaultdict(int, int_keys(data.get("no", {})))
+    return bucket
+
+# --- Журнал активного опроса ---
+poll_journal = None  # Открытый файл журнала
+poll_journal_id = None  # Опрос, которому принадлежит журнал на диске
+
+def journal_poll(record: dict, reset: bool = False):
+    """Дописать событие активного опроса в журнал; reset — начать журнал заново"""
+    global poll_journal, poll_journal_id
+    if reset or poll_journal is None:
+        if poll_journal is not None:
+            poll_journal.close()
+        poll_journal = open(POLL_JOURNAL_FILE, "w" if reset else "a", encoding="utf-8")
+    if record["e"] == "open":
+        poll_journal_id = record["p"]
+    poll_journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+    poll_journal.flush()
+
+def clear_poll_journal(poll_id: str = None):
+    """Удалить журнал; с poll_id — только если журнал все еще принадлежит этому опросу
+    (пока закрывался старый опрос, мог открыться новый)"""
+    global poll_journal, poll_journal_id
+    if poll_id is not None and poll_journal_id != poll_id:
+        return
+    poll_journal_id = None
+    if poll_journal is not None:
+        poll_journal.close()
+        poll_journal = None
+    if os.path.exists(POLL_JOURNAL_FILE):
+        os.remove(POLL_JOURNAL_FILE)
+
+def restore_poll_journal():
+    """Восстановить активный опрос и его голоса из журнала"""
+    global active_poll_id, poll_votes, last_poll_time, poll_journal_id
+    if not os.path.exists(POLL_JOURNAL_FILE):
+        return
+    
+    poll = None
+    votes = {}
+    with open(POLL_JOURNAL_FILE, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Журнал опроса: пропущена поврежденная запись")
+                continue
+            if record["e"] == "open":
+                poll, votes = record, {}
+            elif record["e"] == "vote" and poll is not None:
+                votes[record["u"]] = record["o"]
+    
+    if poll is None or poll["p"] == last_closed_poll_id:
+        clear_poll_journal()
+        return
+    
+    active_poll_id = poll_journal_id = poll["p"]
+    last_poll_time = poll["t"]
+    poll_votes = votes
+    logger.info(f"🗳️ Восстановлен опрос {active_poll_id}: {len(votes)} голосов")
+
+def schedule_poll_close(job_queue):
+    """Закрыть опрос самим, если Telegram не прислал закрытие (например, во время простоя)"""
+    expires = last_poll_time + POLL_DURATION + POLL_CLOSE_GRACE
+    job_queue.run_once(close_expired_poll, when=max(1, expires - clock.now()), data=active_poll_id, name="poll_close")
+
+async def close_expired_poll(context: ContextTypes.DEFAULT_TYPE):
+    if active_poll_id is not None and active_poll_id == context.job.data:
+        logger.info(f"⌛ Опрос {active_poll_id} истек без закрытия от Telegram, закрываем по журналу")
+        await close_active_poll(context)
 
 def create_backup():
     """Создание резервной копии данных"""
@@ -360,8 +1460,10 @@ def create_backup():
             logger.error(f"Ошибка при создании бэкапа: {e}")
 
 # ИСПРАВЛЕННЫЕ АСИНХРОННЫЕ ФУНКЦИИ
-async def save_data(context=None):
-    """Сохранение данных в JSON файл"""
+async def save_data(context=None) -> bool:
+    """Сохранение данных в JSON файл; False — снимок записать не удалось"""
+    global dirty_changes
+    start = perf_counter()
     create_backup()
     data = {
         "stats_yes": dict(stats_yes),
@@ -369,92 +1471,105 @@ async def save_data(context=None):
         "stats_stickers": dict(stats_stickers),
         "stats_photos": dict(stats_photos),
         "usernames": usernames,
-        "sessions": [(t.isoformat(), uid, ans) for t, uid, ans in sessions],
+        "username_history": {str(uid): history for uid, history in username_history.items()},
+        "sessions": sessions,
         "consecutive_yes": dict(consecutive_yes),
         "consecutive_no": dict(consecutive_no),
         "consecutive_button_press": dict(consecutive_button_press),
-        "last_button_press_time": {str(k): v.isoformat() for k, v in last_button_press_time.items()},
-        "achievements_unlocked": {str(uid): list(achs) for uid, achs in achievements_unlocked.items()},
-        "successful_polls": [t.isoformat() for t in successful_polls],
+        "cooldowns": cooldowns.to_dict(clock.now()) if PERSIST_COOLDOWNS else {},
+        "achievement_catalog": achievement_names,
+        "achievements_unlocked": {str(uid): sorted(achs) for uid, achs in achievements_unlocked.items()},
+        "successful_polls": successful_polls,
         "user_levels": {str(uid): levels for uid, levels in user_levels.items()},
+        "text_chart_users": sorted(text_chart_users),
         "asked_today": list(asked_today),
-        "weekly_stats_yes": dict(weekly_stats_yes),
-        "weekly_stats_no": dict(weekly_stats_no),
-        "current_week_key": current_week_key,
+        "content_submissions": {str(uid): submission for uid, submission in content_submissions.items()},
+        "week_buckets": {key: bucket_to_json(bucket) for key, bucket in week_buckets.items()},
+        "month_buckets": {key: bucket_to_json(bucket) for key, bucket in month_buckets.items()},
+        "job_runs": job_runs,
+        "last_closed_poll_id": last_closed_poll_id,
     }
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        with open(DATA_FILE, "wb") as f:
+            f.write(payload)
+        inc_counter("save_data_bytes_total", len(payload))
+        metrics_last[("save_data_bytes", ())] = len(payload)
+        metrics_last[("save_data_time", ())] = clock.now()
+        dirty_changes = 0
         logger.info("Данные успешно сохранены")
+        saved = True
     except Exception as e:
+        inc_counter("save_data_errors_total")
         logger.error(f"Ошибка при сохранении данных: {e}")
+        saved = False
+    observe("save_data_seconds", perf_counter() - start)
+    return saved
 
-async def update_weekly_stats(context=None):
-    """Обновление недельной статистики на основе текущей недели"""
-    global current_week_key, weekly_stats_yes, weekly_stats_no
-    
-    new_week_key = get_current_week_key()
-    
-    # Если неделя сменилась, сбрасываем статистику
-    if new_week_key != current_week_key:
-        weekly_stats_yes.clear()
-        weekly_stats_no.clear()
-        current_week_key = new_week_key
-        logger.info(f"🔄 Недельная статистика сброшена. Новая неделя: {current_week_key}")
-    
-    # Обновляем статистику текущей недели из сессий
-    monday, friday = get_current_week_range()
-    
-    for t, uid, ans in sessions:
-        # Конвертируем время сессии в ЕКБ для сравнения
-        session_time_ekt = t + timedelta(hours=5)
-        if monday <= session_time_ekt <= friday:
-            if ans == "Да, конечно":
-                weekly_stats_yes[uid] += 1
-            elif ans == "Нет":
-                weekly_stats_no[uid] += 1
-
-def load_data():
+def int_keys(mapping: dict) -> dict:
+    """JSON хранит ключи строками — возвращаем id пользователей к int"""
+    return {int(uid): value for uid, value in mapping.items()}
+
+def load_data(restore_journal: bool = True):
+    """Загрузка снимка; restore_journal=False — только чтение: журнал активного опроса
+    не восстанавливается и не очищается (выгрузка рядом с работающим ботом)"""
     global stats_yes, stats_no, stats_stickers, stats_photos
     global usernames, sessions, consecutive_yes, consecutive_no, consecutive_button_press
-    global last_button_press_time, achievements_unlocked, successful_polls, user_levels
-    global asked_today, weekly_stats_yes, weekly_stats_no, current_week_key
+    global achievements_unlocked, successful_polls, user_levels
+    global asked_today, last_closed_poll_id
     
     if not os.path.exists(DATA_FILE):
         logger.info("Файл данных не найден, начинаем с чистого листа")
+        if restore_journal:
+            restore_poll_journal()
         return
     
     try:
         with open(DATA_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
         
-        stats_yes.update(data.get("stats_yes", {}))
-        stats_no.update(data.get("stats_no", {}))
-        stats_stickers.update(data.get("stats_stickers", {}))
-        stats_photos.update(data.get("stats_photos", {}))
-        usernames.update(data.get("usernames", {}))
-        sessions.extend([(datetime.fromisoformat(t), uid, ans) for t, uid, ans in data.get("sessions", [])])
-        consecutive_yes.update(data.get("consecutive_yes", {}))
-        consecutive_no.update(data.get("consecutive_no", {}))
-        consecutive_button_press.update(data.get("consecutive_button_press", {}))
-        successful_polls.extend([datetime.fromisoformat(t) for t in data.get("successful_polls", [])])
+        stats_yes.update(int_keys(data.get("stats_yes", {})))
+        stats_no.update(int_keys(data.get("stats_no", {})))
+        stats_stickers.update(int_keys(data.get("stats_stickers", {})))
+        stats_photos.update(int_keys(data.get("stats_photos", {})))
+        usernames.update(int_keys(data.get("usernames", {})))
+        username_history.update(int_keys(data.get("username_history", {})))
+        # Старый формат хранил ответы строками
+        sessions.extend([(parse_timestamp(t), int(uid), ANSWER_CODES.get(ans, ans)) for t, uid, ans in data.get("sessions", [])])
+        consecutive_yes.update(int_keys(data.get("consecutive_yes", {})))
+        consecutive_no.update(int_keys(data.get("consecutive_no", {})))
+        consecutive_button_press.update(int_keys(data.get("consecutive_button_press", {})))
+        successful_polls.extend([parse_timestamp(t) for t in data.get("successful_polls", [])])
         user_levels.update({int(uid): levels for uid, levels in data.get("user_levels", {}).items()})
+        text_chart_users.update(data.get("text_chart_users", []))
         
         asked_today.update(data.get("asked_today", []))
-        weekly_stats_yes.update(data.get("weekly_stats_yes", {}))
-        weekly_stats_no.update(data.get("weekly_stats_no", {}))
-        current_week_key = data.get("current_week_key")
+        content_submissions.update({int(uid): submission for uid, submission in data.get("content_submissions", {}).items()})
+        if all(f"{period}_buckets" in data for period in PERIODS):
+            for period, (buckets, _, _) in PERIODS.items():
+                buckets.update({key: bucket_from_json(bucket) for key, bucket in data[f"{period}_buckets"].items()})
+        else:
+            rebuild_period_buckets()
+        job_runs.update(data.get("job_runs", {}))
+        last_closed_poll_id = data.get("last_closed_poll_id")
         
-        last_button_press_time_data = data.get("last_button_press_time", {})
-        for k, v in last_button_press_time_data.items():
-            try:
-                last_button_press_time[int(k)] = datetime.fromisoformat(v)
-            except (ValueError, TypeError) as e:
-                logger.warning(f"Ошибка при загрузке времени для пользователя {k}: {e}")
+        try:
+            if "cooldowns" in data:
+                cooldowns.load(data["cooldowns"], clock.now())
+            else:
+                # Старый формат: время последнего нажатия кнопки для всех пользователей
+                cooldowns.load({"button": data.get("last_button_press_time", {})}, clock.now())
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ошибка при загрузке кулдаунов: {e}")
         
+        # id из файла переводим через его каталог: порядок правил в коде мог измениться.
+        # В старом формате вместо id хранились сами названия
+        catalog = data.get("achievement_catalog", [])
         for uid, achs in data.get("achievements_unlocked", {}).items():
             try:
-                achievements_unlocked[int(uid)].update(achs)
+                achievements_unlocked[int(uid)].update(
+                    achievement_id(catalog[ach] if isinstance(ach, int) else ach) for ach in achs
+                )
             except (ValueError, TypeError) as e:
                 logger.warning(f"Ошибка при загрузке ачивок для пользователя {uid}: {e}")
         
@@ -464,12 +1579,16 @@ def load_data():
         logger.error(f"Ошибка формата JSON: {e}")
     except Exception as e:
         logger.error(f"Ошибка при загрузке данных: {e}")
+    
+    if restore_journal:
+        restore_poll_journal()
 
 # --- Выдача ачивок ---
-async def give_achievement(user_id: int, context: ContextTypes.DEFAULT_TYPE, achievement_name: str):
-    if achievement_name not in achievements_unlocked[user_id]:
-        achievements_unlocked[user_id].add(achievement_name)
-        await save_data()
+async def give_achievement(user_id: int, context: ContextTypes.DEFAULT_TYPE, ach_id: int):
+    if ach_id not in achievements_unlocked[user_id]:
+        achievements_unlocked[user_id].add(ach_id)
+        achievement_name = achievement_names[ach_id]
+        await mark_dirty()
         
         try:
             await context.bot.send_message(chat_id=user_id, text=f"🏅 Ачивка: {achievement_name}")
@@ -554,40 +1673,187 @@ async def check_level_up(user_id: int, context: ContextTypes.DEFAULT_TYPE):
         
         logger.info(f"Пользователь {user_id} повысил уровень работяги до {new_worker_level}")
     
-    await save_data()
+    if smoker_threshold > current_smoker_level or worker_threshold > current_worker_level:
+        await mark_dirty()
+
+# --- Движок ачивок ---
+# События, на которые подписываются правила ачивок
+EVENT_VOTE_YES = "vote_yes"
+EVENT_VOTE_NO = "vote_no"
+EVENT_STICKER = "sticker"
+EVENT_PHOTO = "photo"
+EVENT_BUTTON_PRESS = "button_press"
+EVENT_POLL_CLOSED = "poll_closed"
+
+achievement_names = []  # Каталог ачивок: id → название
+achievement_ids = {}  # {название: id}
+achievement_rules = {}  # {id: {"events": (события), "check": функция(state) -> bool, "threshold": int или None}}
+rules_by_event = defaultdict(list)  # {событие: [id правил]}
+
+def achievement_id(name: str) -> int:
+    """id ачивки в каталоге; неизвестное название (например, из старых данных) добавляется"""
+    if name not in achievement_ids:
+        achievement_ids[name] = len(achievement_names)
+        achievement_names.append(name)
+    return achievement_ids[name]
+
+def achievement_rule(name: str, *events: str, threshold: int = None):
+    """Регистрация правила ачивки с подпиской на события.
+    
+    threshold — для правил по счетчикам (стикеры, фото): значение счетчика, раньше
+    которого правило сработать не может. По нему bump_counter решает, проверять ли ачивки.
+    """
+    def decorator(check):
+        ach_id = achievement_id(name)
+        achievement_rules[ach_id] = {"events": events, "check": check, "threshold": threshold}
+        for event in events:
+            rules_by_event[event].append(ach_id)
+        return check
+    return decorator
+
+def get_achievement_state(user_id: int, hour: int, **payload) -> dict:
+    """Инкрементальное состояние пользователя для проверки правил (O(1))"""
+    state = {
+        "consecutive_yes": consecutive_yes[user_id],
+        "consecutive_no": consecutive_no[user_id],
+        "button_presses": consecutive_button_press[user_id],
+        "stickers": stats_stickers[user_id],
+        "photos": stats_photos[user_id],
+        "hour": hour,
+    }
+    state.update(payload)
+    return state
+
+@achievement_rule("Серийный курильщик", EVENT_VOTE_YES)
+def _rule_serial_smoker(state):
+    return state["consecutive_yes"] >= CONSECUTIVE_THRESHOLD
+
+@achievement_rule("Серийный ЗОЖник", EVENT_VOTE_NO)
+def _rule_serial_healthy(state):
+    return state["consecutive_no"] >= CONSECUTIVE_THRESHOLD
+
+@achievement_rule("Ранний перекур", EVENT_VOTE_YES)
+def _rule_early_smoke(state):
+    return state["consecutive_yes"] >= 1 and 0 <= state["hour"] <= 7
+
+@achievement_rule("Ночная смена", EVENT_VOTE_YES)
+def _rule_night_shift(state):
+    return state["consecutive_yes"] >= 1 and 17 <= state["hour"] <= 23
+
+@achievement_rule("Стикеро(WO)MAN", EVENT_STICKER, threshold=ACHIEVEMENT_STICKERS_20)
+def _rule_stickers(state):
+    return state["stickers"] >= ACHIEVEMENT_STICKERS_20
+
+@achievement_rule("Мемолог", EVENT_PHOTO, threshold=ACHIEVEMENT_PHOTOS_20)
+def _rule_photos(state):
+    return state["photos"] >= ACHIEVEMENT_PHOTOS_20
+
+@achievement_rule("Настойчивый", EVENT_BUTTON_PRESS)
+def _rule_persistent(state):
+    return state["button_presses"] >= 3
 
 # --- Проверка ачивок ---
-async def check_achievements(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    now_utc = datetime.utcnow()
-    now_ekt = now_utc + timedelta(hours=5)
-    
-    week_ago = now_ekt - timedelta(days=7)
-    
-    yes_week = sum(1 for t, uid, ans in sessions 
-                  if uid == user_id and ans == "Да, конечно" 
-                  and (t + timedelta(hours=5)) >= week_ago)
-    no_week = sum(1 for t, uid, ans in sessions 
-                 if uid == user_id and ans == "Нет" 
-                 and (t + timedelta(hours=5)) >= week_ago)
-
-    if consecutive_yes[user_id] >= CONSECUTIVE_THRESHOLD:
-        await give_achievement(user_id, context, "Серийный курильщик")
-    if consecutive_no[user_id] >= CONSECUTIVE_THRESHOLD:
-        await give_achievement(user_id, context, "Серийный ЗОЖник")
-
-    h = now_ekt.hour
-    if consecutive_yes[user_id] >= 1:
-        if 0 <= h <= 7:
-            await give_achievement(user_id, context, "Ранний перекур")
-        elif 17 <= h <= 23:
-            await give_achievement(user_id, context, "Ночная смена")
-
-    if stats_stickers[user_id] >= ACHIEVEMENT_STICKERS_20:
-        await give_achievement(user_id, context, "Стикеро(WO)MAN")
-    if stats_photos[user_id] >= ACHIEVEMENT_PHOTOS_20:
-        await give_achievement(user_id, context, "Мемолог")
-
-    await check_level_up(user_id, context)
+async def check_achievements(user_id: int, context: ContextTypes.DEFAULT_TYPE, event: str, **payload):
+    """Проверить только правила, подписанные на событие и еще не полученные"""
+    unlocked = achievements_unlocked[user_id]
+    pending = [ach_id for ach_id in rules_by_event[event] if ach_id not in unlocked]
+    
+    if pending:
+        state = get_achievement_state(user_id, clock.hour(clock.now()), **payload)
+        for ach_id in pending:
+            if achievement_rules[ach_id]["check"](state):
+                await give_achievement(user_id, context, ach_id)
+    
+    if event in (EVENT_VOTE_YES, EVENT_VOTE_NO):
+        await check_level_up(user_id, context)
+
+def backfill_achievement(ach_id: int) -> list:
+    """Массовая выдача правила по истории без уведомлений. Возвращает новых обладателей"""
+    rule = achievement_rules[ach_id]
+    granted = []
+    
+    # Голоса проигрываем по истории, восстанавливая серии так же, как при закрытии опросов
+    if EVENT_VOTE_YES in rule["events"] or EVENT_VOTE_NO in rule["events"]:
+        streak_yes = defaultdict(int)
+        streak_no = defaultdict(int)
+        for t, uid, ans in sessions:
+            if ans == ANSWER_YES:
+                event = EVENT_VOTE_YES
+                streak_yes[uid] += 1
+                streak_no[uid] = 0
+            elif ans == ANSWER_NO:
+                event = EVENT_VOTE_NO
+                streak_no[uid] += 1
+                streak_yes[uid] = 0
+            else:
+                continue
+            
+            if event not in rule["events"] or ach_id in achievements_unlocked[uid]:
+                continue
+            
+            state = get_achievement_state(
+                uid, clock.hour(t),
+                consecutive_yes=streak_yes[uid], consecutive_no=streak_no[uid]
+            )
+            if rule["check"](state):
+                achievements_unlocked[uid].add(ach_id)
+                granted.append(uid)
+    
+    # Для счетчиков истории событий нет — проверяем по текущим значениям
+    if {EVENT_STICKER, EVENT_PHOTO, EVENT_BUTTON_PRESS} & set(rule["events"]):
+        hour = clock.hour(clock.now())
+        known_users = set(stats_stickers) | set(stats_photos) | set(consecutive_button_press)
+        for uid in known_users:
+            if ach_id in achievements_unlocked[uid]:
+                continue
+            if rule["check"](get_achievement_state(uid, hour)):
+                achievements_unlocked[uid].add(ach_id)
+                granted.append(uid)
+    
+    logger.info(f"Бэкфилл ачивки '{achievement_names[ach_id]}': выдано {len(granted)} пользователям")
+    return granted
+
+# --- Отложенная запись счетчиков ---
+dirty_changes = 0  # Изменения в памяти, еще не записанные на диск
+
+register_gauge("dirty_changes", lambda: dirty_changes)
+
+async def mark_dirty(count: int = 1):
+    """Отметить изменения; при накоплении COUNTER_FLUSH_COUNT сразу пишем на диск"""
+    global dirty_changes
+    dirty_changes += count
+    if dirty_changes >= COUNTER_FLUSH_COUNT:
+        inc_counter("dirty_flushes_total", reason="count")
+        await save_data()
+
+async def flush_dirty(context=None):
+    """Периодическая запись накопленных изменений"""
+    if dirty_changes:
+        inc_counter("dirty_flushes_total", reason="interval")
+        await save_data()
+
+async def remember_username(user) -> str:
+    """Запомнить имя пользователя; изменением считается только новое имя, прежнее уходит в историю"""
+    username = user.username or user.first_name
+    old = usernames.get(user.id)
+    if old != username:
+        if old is not None:
+            username_history[user.id].append([clock.now(), old])
+        usernames[user.id] = username
+        await mark_dirty()
+    return username
+
+async def bump_counter(user_id: int, context: ContextTypes.DEFAULT_TYPE, counter: dict, event: str):
+    """Увеличить счетчик пользователя: ачивки проверяются, только пока есть неполученное
+    правило, чей порог уже достигнут; запись на диск — отложенная"""
+    value = counter[user_id] = counter[user_id] + 1
+    unlocked = achievements_unlocked.get(user_id, ())
+    # Правило без порога проверяется всегда; добавленное позже правило с порогом ниже
+    # текущего значения сработает на следующем событии
+    if any(ach_id not in unlocked and (achievement_rules[ach_id]["threshold"] or 0) <= value
+           for ach_id in rules_by_event[event]):
+        await check_achievements(user_id, context, event)
+    await mark_dirty()
 
 # --- Функции для группировки топов ---
 def get_grouped_top(stats_dict, level_func):
@@ -627,101 +1893,77 @@ def get_grouped_top(stats_dict, level_func):
     return result
 
 # --- ОБНОВЛЕННАЯ ФУНКЦИЯ ПЯТНИЧНОГО НАГРАЖДЕНИЯ ---
-async def friday_rewards(context: ContextTypes.DEFAULT_TYPE):
-    """Пятничное награждение по недельному топу"""
-    now_ekt = datetime.utcnow() + timedelta(hours=5)
+MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+def format_medal_lines(top: list) -> str:
+    """Строки топа: одна строка на место, участники с равным счетом — через запятую"""
+    places = defaultdict(list)
+    for place, username, count, level in top:
+        places[place].append(f"{username} — {count} раз ({level})")
+    return "".join(f"{MEDALS.get(place, '🏅')} {', '.join(winners)}\n" for place, winners in places.items())
+
+def build_weekly_summary() -> str:
+    """Текст пятничных итогов по корзине текущей недели"""
+    week = current_week()
+    top_smokers_grouped = get_grouped_top(week["yes"], get_smoker_level)
+    top_workers_grouped = get_grouped_top(week["no"], get_worker_level)
     
-    if now_ekt.weekday() != 4 or now_ekt.hour < 16:
-        return
+    week_range = get_week_range_display()
+    message = f"🎉 *ПЯТНИЦА! Подводим итоги недели {week_range}!* 🎉\n\n"
+    
+    if top_smokers_grouped:
+        message += "🏆 *Топ курильщиков этой недели:*\n"
+        message += format_medal_lines(top_smokers_grouped) + "\n"
+    else:
+        message += "🚭 На этой неделе никто не курил\n\n"
+    
+    if top_workers_grouped:
+        message += "💪 *Топ работяг этой недели:*\n"
+        message += format_medal_lines(top_workers_grouped)
+    else:
+        message += "💼 На этой неделе никто не работал\n"
     
+    message += f"\n📊 *Статистика за неделю {week_range}:*\n"
+    message += f"• Перекуров: {week['successful']}\n"
+    message += f"• Голосов: {week['votes']}\n"
+    
+    message += "\nХороших выходных! 😊"
+    
+    return message
+
+def build_weekly_digest() -> str:
+    """Промежуточные итоги недели: лидеры на текущий момент, O(пользователей)"""
+    week = current_week()
+    message = f"📈 *Промежуточные итоги недели {get_week_range_display()}*\n\n"
+    
+    if not week["votes"]:
+        return message + "Пока ни одного голоса — всё впереди!"
+    
+    for title, stats, level_func in (
+        ("🚬 *Лидеры курильщиков:*", week["yes"], get_smoker_level),
+        ("💪 *Лидеры работяг:*", week["no"], get_worker_level),
+    ):
+        top = get_grouped_top(stats, level_func)
+        if top:
+            message += f"{title}\n{format_medal_lines(top)}\n"
+    
+    message += f"📊 Опросов: {week['polls']}, перекуров: {week['successful']}, голосов: {week['votes']}"
+    return message
+
+async def weekly_digest(context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка промежуточных итогов недели в группу"""
+    try:
+        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=build_weekly_digest(), parse_mode='Markdown')
+        logger.info("📈 Промежуточные итоги недели отправлены")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при отправке промежуточных итогов: {e}")
+
+async def friday_rewards(context: ContextTypes.DEFAULT_TYPE):
+    """Пятничное награждение по недельному топу"""
     logger.info("🎉 Запуск пятничного награждения по недельному топу")
     
     try:
-        await update_weekly_stats()
-        
-        top_smokers_grouped = get_grouped_top(dict(weekly_stats_yes), get_smoker_level)
-        top_workers_grouped = get_grouped_top(dict(weekly_stats_no), get_worker_level)
-        
-        week_range = get_week_range_display()
-        message = f"🎉 *ПЯТНИЦА! Подводим итоги недели {week_range}!* 🎉\n\n"
-        
-        if top_smokers_grouped:
-            message += "🏆 *Топ курильщиков этой недели:*\n"
-            
-            current_place = None
-            current_winners = []
-            
-            for place, username, count, level in top_smokers_grouped:
-                if place != current_place:
-                    if current_winners:
-                        if len(current_winners) == 1:
-                            medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                            message += f"{medal} {current_winners[0]}\n"
-                        else:
-                            medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                            winners_text = ", ".join(current_winners)
-                            message += f"{medal} {winners_text}\n"
-                    
-                    current_place = place
-                    current_winners = [f"{username} — {count} раз ({level})"]
-                else:
-                    current_winners.append(f"{username} — {count} раз ({level})")
-            
-            if current_winners:
-                if len(current_winners) == 1:
-                    medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                    message += f"{medal} {current_winners[0]}\n"
-                else:
-                    medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                    winners_text = ", ".join(current_winners)
-                    message += f"{medal} {winners_text}\n"
-            
-            message += "\n"
-        else:
-            message += "🚭 На этой неделе никто не курил\n\n"
-        
-        if top_workers_grouped:
-            message += "💪 *Топ работяг этой недели:*\n"
-            
-            current_place = None
-            current_winners = []
-            
-            for place, username, count, level in top_workers_grouped:
-                if place != current_place:
-                    if current_winners:
-                        if len(current_winners) == 1:
-                            medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                            message += f"{medal} {current_winners[0]}\n"
-                        else:
-                            medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                            winners_text = ", ".join(current_winners)
-                            message += f"{medal} {winners_text}\n"
-                    
-                    current_place = place
-                    current_winners = [f"{username} — {count} раз ({level})"]
-                else:
-                    current_winners.append(f"{username} — {count} раз ({level})")
-            
-            if current_winners:
-                if len(current_winners) == 1:
-                    medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                    message += f"{medal} {current_winners[0]}\n"
-                else:
-                    medal = "🥇" if current_place == 1 else "🥈" if current_place == 2 else "🥉"
-                    winners_text = ", ".join(current_winners)
-                    message += f"{medal} {winners_text}\n"
-        else:
-            message += "💼 На этой неделе никто не работал\n"
-        
-        monday, friday = get_current_week_range()
-        week_sessions = [s for s in sessions if monday <= (s[0] + timedelta(hours=5)) <= friday]
-        week_polls = [p for p in successful_polls if monday <= (p + timedelta(hours=5)) <= friday]
-        
-        message += f"\n📊 *Статистика за неделю {week_range}:*\n"
-        message += f"• Перекуров: {len(week_polls)}\n"
-        message += f"• Голосов: {len(week_sessions)}\n"
-        
-        message += "\nХороших выходных! 😊"
+        message = build_weekly_summary()
         
         await context.bot.send_message(
             chat_id=GROUP_CHAT_ID,
@@ -737,100 +1979,178 @@ async def friday_rewards(context: ContextTypes.DEFAULT_TYPE):
 # --- СИСТЕМА КОНТЕНТА ДНЯ ---
 def get_active_users():
     """Получить список активных пользователей за последние 7 дней"""
-    now_ekt = datetime.utcnow() + timedelta(hours=5)
-    week_ago = now_ekt - timedelta(days=7)
+    week_ago = clock.now() - 7 * DAY
     active_users = set()
     
     for t, uid, _ in sessions:
-        session_time_ekt = t + timedelta(hours=5)
-        if session_time_ekt >= week_ago:
+        if t >= week_ago:
             active_users.add(uid)
     
     return list(active_users)
 
-def reset_daily_content():
-    """Сброс состояния ежедневного контента"""
+def reset_daily_content(context=None):
+    """Сброс состояния ежедневного контента (снимок пишет вызывающий: планировщик или публикация)"""
     global asked_today, content_submissions, current_content_author
     asked_today.clear()
     content_submissions.clear()
     current_content_author = None
     logger.info("🔄 Состояние ежедневного контента сброшено")
 
+# Виды контента: {поле сообщения: (название для автора, метод отправки по file_id, есть ли подпись)}
+CONTENT_KINDS = {
+    "photo": ("картинка", "send_photo", True),
+    "video": ("видео", "send_video", True),
+    "audio": ("аудио", "send_audio", True),
+    "document": ("файл", "send_document", True),
+    "animation": ("GIF", "send_animation", True),
+    "sticker": ("стикер", "send_sticker", False),
+    "voice": ("голосовое сообщение", "send_voice", False),
+}
+MEDIA_GROUP_TYPES = {"photo": InputMediaPhoto, "video": InputMediaVideo}
+
+def content_item(message) -> dict:
+    """Элемент контента из сообщения: всё, чтобы переслать его после рестарта"""
+    item = {
+        "chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "kind": "text",
+        "text": message.text,
+        "caption": message.caption,
+        "media_group_id": message.media_group_id,
+    }
+    for kind in CONTENT_KINDS:
+        media = getattr(message, kind)
+        if media:
+            item["kind"] = kind
+            item["file_id"] = media[-1].file_id if kind == "photo" else media.file_id
+            break
+    return item
+
+async def send_with_retry(send, what: str):
+    """Отправка с ограниченным числом повторов и растущей паузой.
+    Ошибки запроса (BadRequest/Forbidden) не повторяются."""
+    delay = CONTENT_RETRY_DELAY
+    for attempt in range(1, CONTENT_SEND_ATTEMPTS + 1):
+        try:
+            return await send()
+        except (BadRequest, Forbidden):
+            raise
+        except TelegramError as e:
+            if attempt == CONTENT_SEND_ATTEMPTS:
+                raise
+            wait = e.retry_after if isinstance(e, RetryAfter) else delay
+            logger.warning(f"⚠️ {what}: попытка {attempt} не удалась ({e}), повтор через {wait} сек")
+            await asyncio.sleep(wait)
+            delay *= 2
+
+async def publish_item(bot, item: dict):
+    """Опубликовать элемент: копией исходного сообщения, а если его уже нет — по file_id"""
+    try:
+        await send_with_retry(
+            lambda: bot.copy_message(chat_id=GROUP_CHAT_ID, from_chat_id=item["chat_id"], message_id=item["message_id"]),
+            "copy_message"
+        )
+        return
+    except BadRequest as e:
+        logger.warning(f"⚠️ Не удалось скопировать сообщение {item['message_id']}: {e}, отправляем по file_id")
+    
+    if item["kind"] == "text":
+        await send_with_retry(lambda: bot.send_message(chat_id=GROUP_CHAT_ID, text=item["text"]), "send_message")
+        return
+    
+    _, method, has_caption = CONTENT_KINDS[item["kind"]]
+    params = {"chat_id": GROUP_CHAT_ID, item["kind"]: item["file_id"]}
+    if has_caption:
+        params["caption"] = item["caption"]
+    await send_with_retry(lambda: getattr(bot, method)(**params), method)
+
+async def publish_submission(bot, items: list):
+    """Опубликовать контент одного автора; альбом фото/видео — одной медиагруппой"""
+    if len(items) > 1 and all(item["kind"] in MEDIA_GROUP_TYPES for item in items):
+        media = [MEDIA_GROUP_TYPES[item["kind"]](item["file_id"], caption=item["caption"]) for item in items]
+        await send_with_retry(lambda: bot.send_media_group(chat_id=GROUP_CHAT_ID, media=media), "send_media_group")
+        return
+    for item in items:
+        await publish_item(bot, item)
+
 async def ask_for_content(context: ContextTypes.DEFAULT_TYPE, user_id: int = None):
     """Запросить контент у пользователя"""
     global current_content_author
     
-    now_ekt = datetime.utcnow() + timedelta(hours=5)
-    if now_ekt.weekday() >= 5:
+    if clock.local().weekday() >= 5:
         logger.info("📅 Сегодня выходной, пропускаем запрос контента")
         return
     
-    if user_id is None:
-        active_users = get_active_users()
-        if not active_users:
-            logger.info("👥 Нет активных пользователей для запроса контента")
-            return
+    for _ in range(CONTENT_MAX_PICKS):
+        if user_id is None:
+            active_users = get_active_users()
+            if not active_users:
+                logger.info("👥 Нет активных пользователей для запроса контента")
+                return
+            
+            available_users = [uid for uid in active_users if uid not in asked_today]
+            if not available_users:
+                logger.info("📝 Все активные пользователи уже были опрошены сегодня")
+                return
+            
+            user_id = random.choice(available_users)
         
-        available_users = [uid for uid in active_users if uid not in asked_today]
-        if not available_users:
-            logger.info("📝 Все активные пользователи уже были опрошены сегодня")
-            return
+        current_content_author = user_id
+        asked_today.add(user_id)
         
-        user_id = random.choice(available_users)
+        try:
+            await send_with_retry(lambda: context.bot.send_message(
+                chat_id=user_id,
+                text="🎭 *Привет! Ты сегодняшний счастливчик!*\n\n"
+                     "Отправь мне любой контент для *анонимной* публикации в общем чате:\n"
+                     "• 📸 Картинка/мем\n"
+                     "• 🎬 Видео/GIF\n" 
+                     "• 🎵 Музыка/аудио\n"
+                     "• 📝 Текст (анекдот, шутка, факт)\n"
+                     "• 📎 Файл\n\n"
+                     "Я просто перешлю твой контент в группу *без указания автора*.\n\n"
+                     "Контент будет опубликован в 10:00 ⏰",
+                parse_mode='Markdown'
+            ), "запрос контента")
+            
+            logger.info(f"📨 Запрос контента отправлен пользователю {user_id}")
+            await save_data()
+            return
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка при отправке запроса пользователю {user_id}: {e}")
+            user_id = None
     
-    current_content_author = user_id
-    asked_today.add(user_id)
+    logger.warning(f"⚠️ Запрос контента не доставлен после {CONTENT_MAX_PICKS} попыток")
+
+class AskedTodayFilter(filters.MessageFilter):
+    """Сообщения от пользователей, у которых сегодня запрошен контент"""
     
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="🎭 *Привет! Ты сегодняшний счастливчик!*\n\n"
-                 "Отправь мне любой контент для *анонимной* публикации в общем чате:\n"
-                 "• 📸 Картинка/мем\n"
-                 "• 🎬 Видео/GIF\n" 
-                 "• 🎵 Музыка/аудио\n"
-                 "• 📝 Текст (анекдот, шутка, факт)\n"
-                 "• 📎 Файл\n\n"
-                 "Я просто перешлю твой контент в группу *без указания автора*.\n\n"
-                 "Контент будет опубликован в 10:00 ⏰",
-            parse_mode='Markdown'
-        )
-        
-        logger.info(f"📨 Запрос контента отправлен пользователю {user_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке запроса пользователю {user_id}: {e}")
-        await ask_for_content(context)
+    def filter(self, message) -> bool:
+        return message.from_user is not None and message.from_user.id in asked_today
 
 async def handle_content_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка любого отправленного контента"""
     user_id = update.effective_user.id
     message = update.message
-    
-    if user_id not in asked_today:
-        return
+    await remember_username(update.effective_user)
     
     try:
+        item = content_item(message)
+        submission = content_submissions.get(user_id)
+        if submission and item["media_group_id"] and submission["items"][-1]["media_group_id"] == item["media_group_id"]:
+            # Следующая часть того же альбома
+            submission["items"].append(item)
+            await save_data()
+            return
+        
         content_submissions[user_id] = {
-            "message": message,
-            "date": datetime.utcnow()
+            "items": [item],
+            "date": clock.now()
         }
+        await save_data()
         
-        content_type = "текст"
-        if message.photo:
-            content_type = "картинка"
-        elif message.video:
-            content_type = "видео" 
-        elif message.audio:
-            content_type = "аудио"
-        elif message.document:
-            content_type = "файл"
-        elif message.animation:
-            content_type = "GIF"
-        elif message.sticker:
-            content_type = "стикер"
-        elif message.voice:
-            content_type = "голосовое сообщение"
+        content_type = CONTENT_KINDS[item["kind"]][0] if item["kind"] in CONTENT_KINDS else "текст"
         
         await message.reply_text(
             f"✅ Отлично! Твой {content_type} сохранён.\n\n"
@@ -847,140 +2167,103 @@ async def handle_content_submission(update: Update, context: ContextTypes.DEFAUL
 
 async def publish_daily_content(context: ContextTypes.DEFAULT_TYPE):
     """Публикация ежедневного контента в 10:00"""
-    today_ekt = (datetime.utcnow() + timedelta(hours=5)).date()
-    
-    if (datetime.utcnow() + timedelta(hours=5)).weekday() >= 5:
+    if clock.local().weekday() >= 5:
         logger.info("📅 Сегодня выходной, пропускаем публикацию контента")
         return
     
     if not content_submissions:
         logger.info("📭 Нет контента для публикации сегодня")
         try:
-            await context.bot.send_message(
+            await send_with_retry(lambda: context.bot.send_message(
                 chat_id=GROUP_CHAT_ID,
                 text="📰 *Контент дня*\n\n"
                      "Сегодня никто не прислал контент для публикации 😔\n\n"
                      "Завтра у кого-то другого будет шанс! 🎲",
                 parse_mode='Markdown'
-            )
+            ), "уведомление об отсутствии контента")
         except Exception as e:
             logger.error(f"❌ Ошибка при отправке уведомления об отсутствии контента: {e}")
+        reset_daily_content()
+        await save_data()
         return
     
     try:
-        await context.bot.send_message(
+        await send_with_retry(lambda: context.bot.send_message(
             chat_id=GROUP_CHAT_ID,
             text="📰 *Контент дня!*\n\n"
                  "Сегодняшний анонимный контент от одного из участников:",
             parse_mode='Markdown'
-        )
-        
-        for user_id, submission in content_submissions.items():
-            message = submission["message"]
-            
-            if message.text:
-                await context.bot.send_message(
-                    chat_id=GROUP_CHAT_ID,
-                    text=message.text
-                )
-            elif message.photo:
-                await context.bot.send_photo(
-                    chat_id=GROUP_CHAT_ID,
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption
-                )
-            elif message.video:
-                await context.bot.send_video(
-                    chat_id=GROUP_CHAT_ID,
-                    video=message.video.file_id,
-                    caption=message.caption
-                )
-            elif message.audio:
-                await context.bot.send_audio(
-                    chat_id=GROUP_CHAT_ID,
-                    audio=message.audio.file_id,
-                    caption=message.caption
-                )
-            elif message.document:
-                await context.bot.send_document(
-                    chat_id=GROUP_CHAT_ID,
-                    document=message.document.file_id,
-                    caption=message.caption
-                )
-            elif message.animation:
-                await context.bot.send_animation(
-                    chat_id=GROUP_CHAT_ID,
-                    animation=message.animation.file_id,
-                    caption=message.caption
-                )
-            elif message.sticker:
-                await context.bot.send_sticker(
-                    chat_id=GROUP_CHAT_ID,
-                    sticker=message.sticker.file_id
-                )
-            elif message.voice:
-                await context.bot.send_voice(
-                    chat_id=GROUP_CHAT_ID,
-                    voice=message.voice.file_id
-                )
-        
-        await context.bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text="🎭 *Контент опубликован анонимно*\n\n"
-                 "Завтра у другого участника будет шанс поделиться чем-то интересным!",
-            parse_mode='Markdown'
-        )
-        
-        logger.info(f"✅ Опубликован контент дня от {len(content_submissions)} пользователя(ей)")
-        
+        ), "заголовок контента дня")
     except Exception as e:
-        logger.error(f"❌ Ошибка при публикации контента дня: {e}")
+        logger.error(f"❌ Ошибка при отправке заголовка контента дня: {e}")
+    
+    # Каждый автор публикуется независимо: сбой одной отправки не отменяет остальные
+    results = await asyncio.gather(
+        *(publish_submission(context.bot, submission["items"]) for submission in content_submissions.values()),
+        return_exceptions=True
+    )
+    published = 0
+    for user_id, result in zip(content_submissions, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Не удалось опубликовать контент пользователя {user_id}: {result}")
+        else:
+            published += 1
+    
+    if published:
+        try:
+            await send_with_retry(lambda: context.bot.send_message(
+                chat_id=GROUP_CHAT_ID,
+                text="🎭 *Контент опубликован анонимно*\n\n"
+                     "Завтра у другого участника будет шанс поделиться чем-то интересным!",
+                parse_mode='Markdown'
+            ), "подвал контента дня")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при отправке подвала контента дня: {e}")
+    
+    logger.info(f"✅ Опубликован контент дня от {published} из {len(content_submissions)} пользователя(ей)")
     
     reset_daily_content()
+    await save_data()
 
 # --- ОБНОВЛЕННАЯ ФУНКЦИЯ handle_button ---
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    username = update.effective_user.username or update.effective_user.first_name
-    usernames[user_id] = username
+    username = await remember_username(update.effective_user)
     
-    now = datetime.now()
-    last_press = last_button_press_time[user_id]
+    now = clock.now()
+    remaining = cooldowns.hit("button", user_id, now)
     
-    if now - last_press < COOLDOWN:
-        remaining = COOLDOWN - (now - last_press)
+    if remaining:
         await update.message.reply_text(
-            f"⏳ Подожди еще {int(remaining.total_seconds() // 60)} минут(ы) перед следующим запросом.",
+            f"⏳ Подожди еще {remaining // 60} минут(ы) перед следующим запросом.",
             reply_markup=reply_markup
         )
         return
     
-    last_button_press_time[user_id] = now
     consecutive_button_press[user_id] += 1
     
-    if consecutive_button_press[user_id] >= 3:
-        await give_achievement(user_id, context, "Настойчивый")
+    await check_achievements(user_id, context, EVENT_BUTTON_PRESS)
     
-    global active_poll_id, active_poll_options, poll_votes, last_poll_time
+    global active_poll_id, poll_votes, last_poll_time
     if active_poll_id is not None:
         await update.message.reply_text("Уже есть активный опрос! Голосуй там.", reply_markup=reply_markup)
         return
     
     last_poll_time = now
-    poll_options = ["Да, конечно", "Нет"]
-    active_poll_options = poll_options
     
     try:
         message = await context.bot.send_poll(
             chat_id=GROUP_CHAT_ID,
             question=f"Курить? (от @{username})",
-            options=poll_options,
+            options=list(ANSWERS),
             is_anonymous=False,
             allows_multiple_answers=False,
             open_period=POLL_DURATION
         )
         active_poll_id = message.poll.id
         poll_votes = {}
+        journal_poll({"e": "open", "p": active_poll_id, "t": last_poll_time}, reset=True)
+        schedule_poll_close(context.job_queue)
         logger.info(f"Создан новый опрос {active_poll_id} пользователем {user_id}")
         
     except Exception as e:
@@ -1006,34 +2289,93 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(text)
 
+def build_detailed_caption() -> str:
+    """Сводка /stats_detailed по массивам сессий"""
+    day_start = clock.bounds()["day_start"]
+    times = get_session_arrays()["t"]
+    today_votes = int(np.count_nonzero(times >= day_start))
+    week_votes = int(np.count_nonzero(times >= day_start - 7 * DAY))
+    
+    hour_counts = np.bincount(clock.hour(times), minlength=24)
+    day_counts = np.bincount(clock.weekday(times), minlength=7)
+    most_active_hour = (int(hour_counts.argmax()), int(hour_counts.max()))
+    most_active_day = (int(day_counts.argmax()), int(day_counts.max()))
+    
+    return f"""📊 Детальная статистика:
+
+📅 Сегодня голосов: {today_votes}
+📅 За неделю: {week_votes}
+🕐 Самый активный час: {most_active_hour[0]}:00 ({most_active_hour[1]} голосов)
+📆 Самый активный день: {WEEKDAYS[most_active_day[0]]} ({most_active_day[1]} голосов)"""
+
+def build_me_text(user_id: int, title: str) -> str:
+    """Сводка /me: голоса, уровни и текущая серия"""
+    yes_count = stats_yes[user_id]
+    no_count = stats_no[user_id]
+    total = yes_count + no_count
+    participation_rate = (total / len(successful_polls)) * 100 if successful_polls else 0
+    
+    smoker_level, _ = get_smoker_level(yes_count)
+    worker_level, _ = get_worker_level(no_count)
+    
+    current_streak = max(consecutive_yes[user_id], consecutive_no[user_id])
+    streak_type = ""
+    if consecutive_yes[user_id] == current_streak:
+        streak_type = "Да"
+    elif consecutive_no[user_id] == current_streak:
+        streak_type = "Нет"
+    
+    return f"""{title}
+
+🗳️ Всего голосов: {total}
+✅ Сказал 'Да': {yes_count}
+❌ Сказал 'Нет': {no_count}
+📈 Участие в опросах: {participation_rate:.1f}%
+
+🎯 Твои уровни:
+🚬 {smoker_level}
+💪 {worker_level}
+
+🔥 Текущая серия: {current_streak} раз '{streak_type}'"""
+
+async def reply_text_chart(update: Update, kind: str, caption: str, user_id: int = None, busy: bool = False):
+    """Ответ с графиком текстом; busy — запасной вариант, когда пул рендеринга занят"""
+    inc_counter("chart_text_total", chart=kind, reason="busy" if busy else "requested")
+    text = caption
+    if busy:
+        text = f"⏳ Картинки сейчас строятся для других, вот графики текстом.\n\n{text}"
+    chart = create_text_chart(kind, user_id)
+    if chart:
+        text += f"\n\n{chart}"
+    await update.message.reply_text(text, parse_mode='Markdown')
+
 async def show_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Детальная статистика с графиками"""
+    """Детальная статистика с графиками (/stats_detailed text — графики текстом)"""
+    # Текстовые графики ничего не рендерят, кулдаун на них не распространяется
+    text_mode = wants_text_chart(update, context)
+    if not text_mode and await throttled(update, "stats_detailed"):
+        return
+    
     if not sessions:
         await update.message.reply_text("📊 Еще нет данных для статистики.")
         return
     
     try:
-        plot_buf = create_statistics_plot()
+        if text_mode:
+            await reply_text_chart(update, "statistics", build_detailed_caption())
+            return
         
-        if plot_buf:
-            today = datetime.now().date()
-            today_votes = sum(1 for t, _, _ in sessions if t.date() == today)
-            week_ago = today - timedelta(days=7)
-            week_votes = sum(1 for t, _, _ in sessions if t.date() >= week_ago)
-            
-            most_active_hour = Counter(t.hour for t, _, _ in sessions).most_common(1)[0]
-            most_active_day = Counter(t.weekday() for t, _, _ in sessions).most_common(1)[0]
-            days = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-            
-            caption = f"""📊 Детальная статистика:
-
-📅 Сегодня голосов: {today_votes}
-📅 За неделю: {week_votes}
-🕐 Самый активный час: {most_active_hour[0]}:00 ({most_active_hour[1]} голосов)
-📆 Самый активный день: {days[most_active_day[0]]} ({most_active_day[1]} голосов)"""
+        plot, source = await render_chart(("statistics",), update.effective_user.id, create_statistics_plot)
+        
+        if source == "busy":
+            await reply_text_chart(update, "statistics", build_detailed_caption(), busy=True)
+        elif plot:
+            caption = build_detailed_caption()
+            if source == "stale":
+                caption += "\n\n⏳ График из прошлого запроса — новые сейчас строятся."
             
             await update.message.reply_photo(
-                photo=InputFile(plot_buf, filename="stats.png"),
+                photo=InputFile(io.BytesIO(plot), filename=f"stats.{image_extension(plot)}"),
                 caption=caption
             )
         else:
@@ -1044,48 +2386,32 @@ async def show_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Произошла ошибка при создании статистики.")
 
 async def show_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Улучшенная команда /me с графиками и уровнями"""
-    user_id = update.effective_user.id
-    user_sessions = [(t, ans) for t, uid, ans in sessions if uid == user_id]
+    """Улучшенная команда /me с графиками и уровнями (/me text — графики текстом)"""
+    text_mode = wants_text_chart(update, context)
+    if not text_mode and await throttled(update, "me"):
+        return
     
-    if not user_sessions:
+    user_id = update.effective_user.id
+    if not (stats_yes.get(user_id) or stats_no.get(user_id)):
         await update.message.reply_text("📊 У тебя еще нет данных для статистики.")
         return
     
     try:
-        plot_buf = create_user_stats_plot(user_id)
+        caption = build_me_text(user_id, "📊 Твоя расширенная статистика:")
+        if text_mode:
+            await reply_text_chart(update, "user", caption, user_id)
+            return
         
-        if plot_buf:
-            yes_count = stats_yes[user_id]
-            no_count = stats_no[user_id]
-            total = yes_count + no_count
-            participation_rate = (total / len(successful_polls)) * 100 if successful_polls else 0
-            
-            smoker_level, _ = get_smoker_level(yes_count)
-            worker_level, _ = get_worker_level(no_count)
-            
-            current_streak = max(consecutive_yes[user_id], consecutive_no[user_id])
-            streak_type = ""
-            if consecutive_yes[user_id] == current_streak:
-                streak_type = "Да"
-            elif consecutive_no[user_id] == current_streak:
-                streak_type = "Нет"
-            
-            caption = f"""📊 Твоя расширенная статистика:
-
-🗳️ Всего голосов: {total}
-✅ Сказал 'Да': {yes_count}
-❌ Сказал 'Нет': {no_count}
-📈 Участие в опросах: {participation_rate:.1f}%
-
-🎯 Твои уровни:
-🚬 {smoker_level}
-💪 {worker_level}
-
-🔥 Текущая серия: {current_streak} раз '{streak_type}'"""
+        plot, source = await render_chart(("user", user_id), user_id, create_user_stats_plot, user_id)
+        
+        if source == "busy":
+            await reply_text_chart(update, "user", caption, user_id, busy=True)
+        elif plot:
+            if source == "stale":
+                caption += "\n\n⏳ График из прошлого запроса — новые сейчас строятся."
             
             await update.message.reply_photo(
-                photo=InputFile(plot_buf, filename="my_stats.png"),
+                photo=InputFile(io.BytesIO(plot), filename=f"my_stats.{image_extension(plot)}"),
                 caption=caption
             )
         else:
@@ -1097,98 +2423,102 @@ async def show_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_basic_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Базовая текстовая версия /me с уровнями"""
-    user_id = update.effective_user.id
-    yes_count = stats_yes[user_id]
-    no_count = stats_no[user_id]
-    total = yes_count + no_count
-    participation_rate = (total / len(successful_polls)) * 100 if successful_polls else 0
-    
-    smoker_level, _ = get_smoker_level(yes_count)
-    worker_level, _ = get_worker_level(no_count)
-    
-    current_streak = max(consecutive_yes[user_id], consecutive_no[user_id])
-    streak_type = ""
-    if consecutive_yes[user_id] == current_streak:
-        streak_type = "Да"
-    elif consecutive_no[user_id] == current_streak:
-        streak_type = "Нет"
-    
-    text = f"""📊 Твоя статистика:
-
-🗳️ Всего голосов: {total}
-✅ Сказал 'Да': {yes_count}
-❌ Сказал 'Нет': {no_count}
-📈 Участие в опросах: {participation_rate:.1f}%
-
-🎯 Твои уровни:
-🚬 {smoker_level}
-💪 {worker_level}
+    await update.message.reply_text(build_me_text(update.effective_user.id, "📊 Твоя статистика:"))
 
-🔥 Текущая серия: {current_streak} раз '{streak_type}'"""
-    
-    await update.message.reply_text(text)
+async def set_chart_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор вида графиков для /me и /stats_detailed: /charts text или /charts image"""
+    user_id = update.effective_user.id
+    arg = context.args[0].lower() if context.args else ""
+    if arg in TEXT_CHART_ARGS:
+        text_chart_users.add(user_id)
+        await update.message.reply_text("✅ Теперь графики будут приходить текстом. Вернуть картинки: /charts image")
+    elif arg in IMAGE_CHART_ARGS:
+        text_chart_users.discard(user_id)
+        await update.message.reply_text("✅ Теперь графики будут приходить картинками. Текстом: /charts text")
+    else:
+        mode = "текстом" if user_id in text_chart_users else "картинками"
+        await update.message.reply_text(f"📊 Сейчас графики приходят {mode}.\nВыбрать: /charts text или /charts image")
+        return
+    await mark_dirty()
 
 # --- ОБНОВЛЕННАЯ КОМАНДА /top ---
-async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Объединенный топ курильщиков и работяг с недельной и общей статистикой"""
-    if not sessions:
-        await update.message.reply_text("📊 Пока нет статистики.")
-        return
-    
-    await update_weekly_stats()
-    
+def top_section(title: str, stats: dict, level_func) -> str:
+    """Блок топа для /top: заголовок и места с медалями"""
+    if not stats:
+        return f"{title}\nПока нет данных\n"
+    
+    response = f"{title}\n"
+    for place, username, count, level in get_grouped_top(stats, level_func):
+        response += f"{MEDALS.get(place, '🏅')} {username}: {count} раз - {level}\n"
+    return response
+
+def build_top_text() -> str:
+    """Текст объединенного топа для /top"""
     week_range = get_week_range_display()
+    week = current_week()
     response = f"🏆 *ТОП УЧАСТНИКОВ*\n\n"
     
     response += f"📅 *ТЕКУЩАЯ НЕДЕЛЯ ({week_range})*\n\n"
-    
-    if weekly_stats_yes:
-        response += "🚬 *Топ курильщиков (неделя):*\n"
-        smoker_top = get_grouped_top(weekly_stats_yes, get_smoker_level)
-        for place, username, count, level in smoker_top:
-            medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place, "🏅")
-            response += f"{medal} {username}: {count} раз - {level}\n"
-    else:
-        response += "🚬 *Топ курильщиков (неделя):*\nПока нет данных\n"
-    
+    response += top_section("🚬 *Топ курильщиков (неделя):*", week["yes"], get_smoker_level)
     response += "\n"
-    
-    if weekly_stats_no:
-        response += "💪 *Топ работяг (неделя):*\n"
-        worker_top = get_grouped_top(weekly_stats_no, get_worker_level)
-        for place, username, count, level in worker_top:
-            medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place, "🏅")
-            response += f"{medal} {username}: {count} раз - {level}\n"
-    else:
-        response += "💪 *Топ работяг (неделя):*\nПока нет данных\n"
+    response += top_section("💪 *Топ работяг (неделя):*", week["no"], get_worker_level)
     
     response += "\n" + "="*40 + "\n\n"
     
     response += "📊 *ОБЩАЯ СТАТИСТИКА (все время)*\n\n"
+    response += top_section("🚬 *Топ курильщиков (все время):*", stats_yes, get_smoker_level)
+    response += "\n"
+    response += top_section("💪 *Топ работяг (все время):*", stats_no, get_worker_level)
     
-    if stats_yes:
-        response += "🚬 *Топ курильщиков (все время):*\n"
-        overall_smoker_top = get_grouped_top(stats_yes, get_smoker_level)
-        for place, username, count, level in overall_smoker_top:
-            medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place, "🏅")
-            response += f"{medal} {username}: {count} раз - {level}\n"
+    response += f"\n🔄 *Недельная статистика обнуляется каждый понедельник*"
+    
+    return response
+
+def build_period_top_text(period: str, key: str) -> str:
+    """Топ за неделю или месяц из корзин периода — O(пользователей периода)"""
+    buckets, _, parse_key = PERIODS[period]
+    start = parse_key(key)
+    if period == "week":
+        key = start.strftime('%G-%V')
+        title = f"НЕДЕЛЯ {key} ({start.strftime('%d.%m.%Y')} - {(start + timedelta(days=6)).strftime('%d.%m.%Y')})"
     else:
-        response += "🚬 *Топ курильщиков (все время):*\nПока нет данных\n"
+        key = start.strftime('%Y-%m')
+        title = f"МЕСЯЦ {start.strftime('%m.%Y')}"
     
+    bucket = buckets.get(key) or new_bucket()
+    response = f"🏆 *ТОП: {title}*\n\n"
+    response += top_section("🚬 *Топ курильщиков:*", bucket["yes"], get_smoker_level)
     response += "\n"
+    response += top_section("💪 *Топ работяг:*", bucket["no"], get_worker_level)
+    response += f"\n📊 Опросов: {bucket['polls']}, перекуров: {bucket['successful']}, голосов: {bucket['votes']}"
+    return response
+
+async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Объединенный топ курильщиков и работяг с недельной и общей статистикой.
+    /top week 2025-40 и /top month 2025-09 — топ за прошедший период"""
+    if not sessions:
+        await update.message.reply_text("📊 Пока нет статистики.")
+        return
     
-    if stats_no:
-        response += "💪 *Топ работяг (все время):*\n"
-        overall_worker_top = get_grouped_top(stats_no, get_worker_level)
-        for place, username, count, level in overall_worker_top:
-            medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place, "🏅")
-            response += f"{medal} {username}: {count} раз - {level}\n"
-    else:
-        response += "💪 *Топ работяг (все время):*\nПока нет данных\n"
-    
-    response += f"\n🔄 *Недельная статистика обнуляется каждый понедельник*"
+    if context.args:
+        period = context.args[0].lower()
+        try:
+            key = context.args[1] if len(context.args) > 1 else PERIODS[period][1](clock.now())
+            text = build_period_top_text(period, key)
+        except (KeyError, ValueError):
+            await update.message.reply_text(
+                "❓ Формат: /top week ГГГГ-НН или /top month ГГГГ-ММ\n"
+                "Например: /top week 2025-40, /top month 2025-09"
+            )
+            return
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
     
-    await update.message.reply_text(response, parse_mode='Markdown')
+    await update.message.reply_text(build_top_text(), parse_mode='Markdown')
+
+async def show_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Промежуточные итоги текущей недели"""
+    await update.message.reply_text(build_weekly_digest(), parse_mode='Markdown')
 
 # --- Команда HELP ---
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1197,13 +2527,21 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ("/stats", "Общая статистика перекуров"),
         ("/stats_detailed", "Детальная статистика с графиками"),
         ("/me", "Твоя персональная статистика с графиками"),
+        ("/charts", "Графики картинками или текстом (/me text — один раз)"),
         ("/top", "Топ курильщиков и работяг (неделя + общая)"),
+        ("/top week 2025-40", "Топ за неделю (или month 2025-09 — за месяц)"),
+        ("/week", "Промежуточные итоги текущей недели"),
         ("/help", "Показать все команды"),
         ("/time", "Проверить время сервера"),
         ("/reset", "Сброс статистики (только админ)"),
         ("/test_weekly", "Тест еженедельных итогов (админ)"),
         ("/test_content", "Тест системы контента (админ)"),
         ("/jobs", "Показать запланированные задачи (админ)"),
+        ("/backfill", "Выдать ачивку по истории (админ)"),
+        ("/export", "Выгрузка истории в CSV или NPZ (админ)"),
+        ("/perf", "Метрики производительности (админ)"),
+        ("/state", "Память и файлы состояния (админ)"),
+        ("/profile", "Профилирование медленных вызовов (админ)"),
     ]
     text = "📖 Доступные команды:\n\n" + "\n".join([f"{cmd} — {desc}" for cmd, desc in commands])
     await update.message.reply_text(text)
@@ -1211,8 +2549,8 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Дополнительные команды ---
 async def check_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверить время сервера и екатеринбургское время"""
-    now_utc = datetime.utcnow()
-    now_ekt = now_utc + timedelta(hours=5)
+    now_utc = datetime.fromtimestamp(clock.now(), timezone.utc)
+    now_ekt = clock.local()
     
     await update.message.reply_text(
         f"⏰ *Текущее время:*\n"
@@ -1227,33 +2565,39 @@ async def check_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
-async def reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Сброс статистики (только для админа)"""
-    user_id = update.effective_user.id
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("⛔ У тебя нет прав для сброса статистики.")
-        return
-    
+def clear_state():
+    """Очистка всего состояния в памяти"""
+    global session_arrays
     stats_yes.clear()
     stats_no.clear()
     stats_stickers.clear()
     stats_photos.clear()
     usernames.clear()
+    username_history.clear()
     sessions.clear()
     consecutive_yes.clear()
     consecutive_no.clear()
     consecutive_button_press.clear()
-    last_button_press_time.clear()
+    cooldowns.clear()
     achievements_unlocked.clear()
     successful_polls.clear()
     user_levels.clear()
+    text_chart_users.clear()
     content_submissions.clear()
     asked_today.clear()
-    weekly_stats_yes.clear()
-    weekly_stats_no.clear()
-    global current_week_key
-    current_week_key = None
+    week_buckets.clear()
+    month_buckets.clear()
+    render_cache.clear()
+    session_arrays = empty_session_arrays()
+
+async def reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сброс статистики (только для админа)"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для сброса статистики.")
+        return
     
+    clear_state()
     await save_data()
     await update.message.reply_text("🔄 Статистика и ачивки сброшены!")
 
@@ -1301,16 +2645,371 @@ async def show_scheduled_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE
     for i, job in enumerate(jobs, 1):
         message += f"{i}. {job.name}\n"
     
+    now = clock.now()
+    message += "\n📅 Ежедневные задачи (время ЕКБ):\n"
+    for name, job in daily_jobs.items():
+        last_run = job_runs.get(name)
+        last_text = clock.local(last_run).strftime('%d.%m %H:%M') if last_run else "—"
+        message += f"• {name}: последний срок {last_text}, следующий {clock.local(job_due(job, now, forward=True)):%d.%m %H:%M}\n"
+    
     await update.message.reply_text(message)
 
-# --- Вспомогательные функции для планировщика ---
-async def daily_content_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Напоминание о контенте дня в 9:30"""
-    now_ekt = datetime.utcnow() + timedelta(hours=5)
+async def show_perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сводка метрик производительности (только для админа)"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для этой команды.")
+        return
+    
+    def summary(metric, label):
+        rows = []
+        for (name, labels), hist in sorted(metrics_histograms.items(), key=lambda item: item[0]):
+            if name != metric:
+                continue
+            buckets, total, count = hist
+            title = dict(labels).get(label, name)
+            rows.append(
+                f"• {title}: {count} шт, ср. {total / count * 1000:.0f} мс, "
+                f"p95 ≤ {histogram_quantile(hist, 0.95) * 1000:.0f} мс"
+            )
+        return "\n".join(rows) or "• нет данных"
+    
+    telegram_calls = sum(hist[2] for (name, _), hist in metrics_histograms.items() if name == "telegram_request_seconds")
+    telegram_errors = sum(v for (name, _), v in metrics_counters.items() if name == "telegram_errors_total")
+    telegram_429 = sum(v for (name, _), v in metrics_counters.items() if name == "telegram_429_total")
+    last_save_bytes = metrics_last.get(("save_data_bytes", ()), 0)
+    chart_bytes = sum(v for (name, _), v in metrics_counters.items() if name == "chart_bytes_total")
+    baseline_bytes = sum(v for (name, _), v in metrics_counters.items() if name == "chart_baseline_bytes_total")
+    sampled_bytes = sum(v for (name, _), v in metrics_counters.items() if name == "chart_sampled_bytes_total")
+    saved = f", экономия {1 - sampled_bytes / baseline_bytes:.0%} к обычному PNG" if baseline_bytes else ""
+    
+    text = (
+        f"📈 Производительность\n\n"
+        f"⚙️ Обработчики:\n{summary('handler_latency_seconds', 'handler')}\n\n"
+        f"💾 save_data:\n{summary('save_data_seconds', 'save_data')}\n"
+        f"• последний снимок: {last_save_bytes / 1024:.1f} КБ\n\n"
+        f"📊 Графики:\n{summary('chart_render_seconds', 'chart')}\n"
+        f"🗜️ Сжатие:\n{summary('chart_encode_seconds', 'format')}\n"
+        f"• отправлено {chart_bytes / 1024:.0f} КБ{saved}\n\n"
+        f"📡 Telegram: {telegram_calls} вызовов, ошибок {telegram_errors:g}, 429: {telegram_429:g}\n\n"
+        f"⏱️ Лаг задач:\n{summary('job_lag_seconds', 'job')}\n\n"
+        f"🐢 Лаг цикла событий:\n{summary('loop_lag_seconds', 'loop')}\n"
+        f"Зависания:\n{summary('loop_stall_seconds', 'activity')}\n\n"
+        f"🗂️ Сессий: {len(sessions)}, пользователей: {len(usernames)}"
+    )
+    await update.message.reply_text(text)
+
+# --- Учет памяти ---
+STATE_SAMPLE_SIZE = 1000  # Большие списки оцениваем по выборке элементов
+
+# Структуры состояния для /state: {название: функция, возвращающая объект}
+STATE_STRUCTURES = {
+    "sessions": lambda: sessions,
+    "successful_polls": lambda: successful_polls,
+    "stats_yes": lambda: stats_yes,
+    "stats_no": lambda: stats_no,
+    "stats_stickers": lambda: stats_stickers,
+    "stats_photos": lambda: stats_photos,
+    "usernames": lambda: usernames,
+    "username_history": lambda: username_history,
+    "achievements_unlocked": lambda: achievements_unlocked,
+    "user_levels": lambda: user_levels,
+    "text_chart_users": lambda: text_chart_users,
+    "content_submissions": lambda: content_submissions,
+    "week_buckets": lambda: week_buckets,
+    "month_buckets": lambda: month_buckets,
+    "cooldowns": lambda: cooldowns,
+    "poll_votes": lambda: poll_votes,
+    "session_arrays": lambda: session_arrays,
+    "render_cache": lambda: render_cache,
+}
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    """Примерный размер объекта вместе с содержимым; общие объекты считаются один раз"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        return size if obj.flags.owndata else size + obj.nbytes
+    if isinstance(obj, dict):
+        items = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj
+    elif hasattr(obj, "__dict__"):
+        items = [vars(obj)]
+    else:
+        return size
+    
+    if isinstance(obj, list) and len(obj) > STATE_SAMPLE_SIZE:
+        step = len(obj) / STATE_SAMPLE_SIZE
+        sample = [obj[int(i * step)] for i in range(STATE_SAMPLE_SIZE)]
+        return size + sum(deep_sizeof(item, seen) for item in sample) * len(obj) // STATE_SAMPLE_SIZE
+    return size + sum(deep_sizeof(item, seen) for item in items)
+
+def file_size(path: str):
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+def format_bytes(size: int) -> str:
+    if size is None:
+        return "нет файла"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+async def measure_loop_lag() -> float:
+    """Сколько ждет своей очереди колбэк, уже готовый к запуску в цикле событий"""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    start = perf_counter()
+    loop.call_soon(ready.set_result, None)
+    await ready
+    return perf_counter() - start
+
+async def show_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Память структур, файлы данных, последнее сохранение и лаг цикла (только для админа)"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для этой команды.")
+        return
+    
+    lag = await measure_loop_lag()
+    start = perf_counter()
+    rows = []
+    total = 0
+    for name, get in STATE_STRUCTURES.items():
+        obj = get()
+        size = deep_sizeof(obj)
+        total += size
+        rows.append(f"• {name}: {len(obj)} зап., {format_bytes(size)}")
+    accounting = perf_counter() - start
+    
+    save_time = metrics_last.get(("save_data_time", ()))
+    save_seconds = metrics_last.get(("save_data_seconds", ()))
+    save_text = (
+        f"{clock.local(save_time):%d.%m %H:%M:%S} за {save_seconds * 1000:.0f} мс" if save_time else "еще не было"
+    )
+    
+    text = (
+        f"🧠 Состояние бота\n\n"
+        f"💾 Память (≈, подсчет {accounting * 1000:.0f} мс):\n" + "\n".join(rows) + "\n"
+        f"• всего: {format_bytes(total)}\n\n"
+        f"📁 Диск:\n"
+        f"• {DATA_FILE}: {format_bytes(file_size(DATA_FILE))}\n"
+        f"• {BACKUP_FILE}: {format_bytes(file_size(BACKUP_FILE))}\n"
+        f"• {POLL_JOURNAL_FILE}: {format_bytes(file_size(POLL_JOURNAL_FILE))}\n\n"
+        f"🕒 Последнее сохранение: {save_text}\n"
+        f"✏️ Изменений ждут записи: {dirty_changes}\n"
+        f"⏱️ Лаг цикла событий: {lag * 1000:.1f} мс"
+    )
+    await update.message.reply_text(text)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Управление профилированием и отчет по медленным вызовам (только для админа)"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для этой команды.")
+        return
+    
+    args = context.args
+    action = args[0] if args else "status"
+    
+    try:
+        if action == "on":
+            profiling["rate"] = float(args[1]) if len(args) > 1 else 1.0
+        elif action == "off":
+            profiling["rate"] = 0.0
+        elif action == "threshold" and len(args) > 1:
+            profiling["threshold"] = int(args[1]) / 1000
+        elif action == "top":
+            limit = int(args[1]) if len(args) > 1 else 15
+            handler = args[2] if len(args) > 2 else None
+            paths = [path for path in list_profiles() if handler is None or f"_{handler}_" in path]
+            if not paths:
+                await update.message.reply_text("📭 Профилей пока нет")
+                return
+            
+            message = f"🔬 Топ функций по {len(paths)} профилям:\n\n"
+            for func, location, calls, own_time, cum_time in top_profile_functions(paths, limit):
+                message += f"• {cum_time * 1000:.0f} мс ({own_time * 1000:.0f} собств., {calls} выз.) {func} — {location}\n"
+            await update.message.reply_text(message[:4000])
+            return
+        elif action != "status":
+            raise ValueError(action)
+    except (ValueError, IndexError):
+        await update.message.reply_text(
+            "❓ Использование: /profile [status | on [доля] | off | threshold <мс> | top [N] [обработчик]]"
+        )
+        return
+    
+    recent = list_profiles()
+    message = (
+        f"🔬 Профилирование: {'включено' if profiling['rate'] else 'выключено'}\n"
+        f"• Доля вызовов: {profiling['rate']:g}\n"
+        f"• Порог: {profiling['threshold'] * 1000:.0f} мс\n"
+        f"• Сохранено профилей: {len(recent)} (в {PROFILE_DIR})\n"
+    )
+    if recent:
+        message += "\nПоследние:\n" + "\n".join(f"• {os.path.basename(path)}" for path in recent[:5])
+    await update.message.reply_text(message)
+
+async def backfill_achievement_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выдать новую ачивку по истории (только для админа)"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для этой команды.")
+        return
+    
+    name = " ".join(context.args)
+    ach_id = achievement_ids.get(name)
+    if ach_id not in achievement_rules:
+        await update.message.reply_text(
+            "❓ Укажи ачивку: /backfill <название>\n\nДоступные ачивки:\n"
+            + "\n".join(achievement_names[rule_id] for rule_id in achievement_rules)
+        )
+        return
+    
+    granted = backfill_achievement(ach_id)
+    if granted:
+        await save_data()
+    await update.message.reply_text(f"✅ Ачивка '{name}' выдана по истории: {len(granted)} пользователям")
+
+# --- Экспорт данных ---
+EXPORT_EXTENSIONS = {"csv": "zip", "npz": "npz"}  # CSV-таблицы в zip или сжатые колонки NumPy
+USER_COLUMNS = ["user_id", "username", "yes", "no", "stickers", "photos", "smoker_level", "worker_level", "achievements"]
+USER_TEXT_COLUMNS = {"username", "smoker_level", "worker_level", "achievements"}
+
+def export_users() -> list:
+    """Строки пользователей. Собираются в цикле событий: словари статистики меняются только там"""
+    user_ids = sorted(set(usernames) | set(stats_yes) | set(stats_no) | set(stats_stickers) | set(stats_photos))
+    rows = []
+    for uid in user_ids:
+        yes, no = stats_yes.get(uid, 0), stats_no.get(uid, 0)
+        rows.append([
+            uid, usernames.get(uid, ""), yes, no, stats_stickers.get(uid, 0), stats_photos.get(uid, 0),
+            get_smoker_level(yes)[0], get_worker_level(no)[0],
+            ";".join(sorted(achievement_names[ach] for ach in achievements_unlocked.get(uid, ()))),
+        ])
+    return rows
+
+def iter_session_chunks(count: int):
+    """Первые count сессий порциями по EXPORT_CHUNK — без копии всей истории"""
+    for start in range(0, count, EXPORT_CHUNK):
+        yield sessions[start:min(start + EXPORT_CHUNK, count)]
+
+def poll_row(t: int, yes: int, no: int) -> list:
+    return [t, clock.local(t).isoformat(), yes + no, yes, no, int(yes > 0)]
+
+def iter_poll_rows(count: int):
+    """Опросы по сессиям: голоса одного опроса записаны подряд с общим временем"""
+    poll_t, yes, no = None, 0, 0
+    for chunk in iter_session_chunks(count):
+        rows = []
+        for t, uid, ans in chunk:
+            if t != poll_t:
+                if poll_t is not None:
+                    rows.append(poll_row(poll_t, yes, no))
+                poll_t, yes, no = t, 0, 0
+            if ans == ANSWER_YES:
+                yes += 1
+            else:
+                no += 1
+        yield rows
+    if poll_t is not None:
+        yield [poll_row(poll_t, yes, no)]
+
+def write_csv(archive: zipfile.ZipFile, name: str, header: list, chunks) -> int:
+    """Записать таблицу в архив потоком порций строк; возвращает число строк"""
+    written = 0
+    with archive.open(name, "w", force_zip64=True) as raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for rows in chunks:
+            writer.writerows(rows)
+            written += len(rows)
+    return written
+
+def export_csv(path: str, count: int, users: list) -> dict:
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        session_rows = (
+            [(t, clock.local(t).isoformat(), uid, ANSWERS[ans]) for t, uid, ans in chunk]
+            for chunk in iter_session_chunks(count)
+        )
+        return {
+            "sessions": write_csv(archive, "sessions.csv", ["t", "local_time", "user_id", "answer"], session_rows),
+            "polls": write_csv(archive, "polls.csv", ["t", "local_time", "voters", "yes", "no", "successful"], iter_poll_rows(count)),
+            "users": write_csv(archive, "users.csv", USER_COLUMNS, [users]),
+        }
+
+def export_npz(path: str, count: int, users: list) -> dict:
+    """Колоночная выгрузка: массивы сессий уже есть в кэше графиков, опросы считаются по ним"""
+    arrays = get_session_arrays()
+    t, uid, yes = arrays["t"][:count], arrays["uid"][:count], arrays["yes"][:count]
+    poll_t, poll_start, voters = np.unique(t, return_index=True, return_counts=True)
+    poll_yes = np.add.reduceat(yes.astype(np.int64), poll_start) if count else np.empty(0, np.int64)
+    user_columns = {}
+    for name, values in zip(USER_COLUMNS, zip(*users) if users else [()] * len(USER_COLUMNS)):
+        user_columns[f"user_{name}"] = np.array(values, dtype=str if name in USER_TEXT_COLUMNS else np.int64)
+    np.savez_compressed(
+        path,
+        answers=np.array(ANSWERS),
+        session_t=t,
+        session_user_id=uid,
+        session_answer=np.where(yes, ANSWER_YES, ANSWER_NO).astype(np.int8),
+        poll_t=poll_t,
+        poll_voters=voters,
+        poll_yes=poll_yes,
+        **user_columns,
+    )
+    return {"sessions": count, "polls": len(poll_t), "users": len(users)}
+
+def export_data(path: str, fmt: str, count: int, users: list) -> dict:
+    """Записать выгрузку в файл; возвращает число строк по таблицам"""
+    return {"csv": export_csv, "npz": export_npz}[fmt](path, count, users)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка истории для офлайн-анализа (только для админа): /export [csv|npz]"""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("⛔ У тебя нет прав для этой команды.")
+        return
     
-    if now_ekt.weekday() >= 5 or now_ekt.hour != 9 or now_ekt.minute != 30:
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_EXTENSIONS:
+        await update.message.reply_text("❓ Формат: /export csv (таблицы в zip) или /export npz (колонки NumPy)")
         return
     
+    start = perf_counter()
+    users = export_users()
+    filename = f"perekur_{clock.local():%Y%m%d}.{EXPORT_EXTENSIONS[fmt]}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, filename)
+        # Пишем на диск в отдельном потоке: сессии только дописываются, берем первые len(sessions)
+        rows = await asyncio.get_running_loop().run_in_executor(None, export_data, path, fmt, len(sessions), users)
+        size = os.path.getsize(path)
+        observe("export_seconds", perf_counter() - start, format=fmt)
+        inc_counter("export_bytes_total", size, format=fmt)
+        
+        if size > EXPORT_MAX_BYTES:
+            await update.message.reply_text(
+                f"❌ Выгрузка {size / 1024 / 1024:.1f} МБ больше лимита {EXPORT_MAX_BYTES / 1024 / 1024:.0f} МБ. "
+                f"Используй на сервере: python perekur2.py export --format {fmt}"
+            )
+            return
+        
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f, filename=filename,
+                caption=f"📦 Сессий: {rows['sessions']}, опросов: {rows['polls']}, пользователей: {rows['users']} "
+                        f"({size / 1024:.0f} КБ)"
+            )
+
+# --- Вспомогательные функции для планировщика ---
+async def daily_content_reminder(context: ContextTypes.DEFAULT_TYPE):
+    """Напоминание о контенте дня в 9:30"""
     logger.info("📝 Напоминание о контенте дня")
     
     try:
@@ -1339,77 +3038,83 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     user_id = update.poll_answer.user.id
-    username = update.poll_answer.user.username or update.poll_answer.user.first_name
-    usernames[user_id] = username
+    await remember_username(update.poll_answer.user)
     
     selected_options = update.poll_answer.option_ids
     if not selected_options:
         return
     
-    selected_option = active_poll_options[selected_options[0]]
-    poll_votes[user_id] = selected_option
+    answer = selected_options[0]
+    poll_votes[user_id] = answer
+    journal_poll({"e": "vote", "u": user_id, "o": answer})
     
-    logger.info(f"Пользователь {user_id} проголосовал: {selected_option}")
+    logger.info(f"Пользователь {user_id} проголосовал: {ANSWERS[answer]}")
 
 async def handle_poll_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global active_poll_id, poll_votes
     if active_poll_id is None or update.poll.id != active_poll_id:
         return
     
     if update.poll.is_closed:
         logger.info(f"Опрос {active_poll_id} завершен")
-        
-        # Сохраняем только окончательные голоса
-        for user_id, answer in poll_votes.items():
-            if answer == "Да, конечно":
-                stats_yes[user_id] += 1
-                consecutive_yes[user_id] += 1
-                consecutive_no[user_id] = 0
-            elif answer == "Нет":
-                stats_no[user_id] += 1
-                consecutive_no[user_id] += 1
-                consecutive_yes[user_id] = 0
-            
-            sessions.append((last_poll_time, user_id, answer))
-            await check_achievements(user_id, context)
-        
-        # Обновляем недельную статистику
-        await update_weekly_stats()
-        
-        # Проверяем успешность опроса
-        yes_votes = sum(1 for vote in poll_votes.values() if vote == "Да, конечно")
-        if yes_votes > 0:
-            successful_polls.append(last_poll_time)
-            logger.info(f"Успешный перекур! {yes_votes} голосов 'Да'")
-        
-        await save_data()
-        
-        # Сбрасываем состояние
-        active_poll_id = None
-        active_poll_options = []
-        poll_votes = {}
+        await close_active_poll(context)
+
+async def close_active_poll(context: ContextTypes.DEFAULT_TYPE):
+    """Учесть окончательные голоса активного опроса и сбросить его состояние"""
+    global active_poll_id, poll_votes, last_closed_poll_id
+    
+    # Весь опрос учитывается без await: любое сохранение (в том числе из других
+    # обработчиков) видит либо опрос целиком вместе с last_closed_poll_id, либо
+    # ничего, и журнал после рестарта не учтет голоса повторно
+    votes = poll_votes
+    events = []
+    for user_id, answer in votes.items():
+        if answer == ANSWER_YES:
+            stats_yes[user_id] += 1
+            consecutive_yes[user_id] += 1
+            consecutive_no[user_id] = 0
+            events.append((user_id, EVENT_VOTE_YES))
+        elif answer == ANSWER_NO:
+            stats_no[user_id] += 1
+            consecutive_no[user_id] += 1
+            consecutive_yes[user_id] = 0
+            events.append((user_id, EVENT_VOTE_NO))
+        sessions.append((last_poll_time, user_id, answer))
+    
+    yes_votes = sum(1 for vote in votes.values() if vote == ANSWER_YES)
+    record_poll_buckets(last_poll_time, votes)
+    if yes_votes > 0:
+        successful_polls.append(last_poll_time)
+        logger.info(f"Успешный перекур! {yes_votes} голосов 'Да'")
+    
+    closed_poll_id = last_closed_poll_id = active_poll_id
+    active_poll_id = None
+    poll_votes = {}
+    
+    # Ачивки и уровни зависят только от счетчиков самого пользователя,
+    # поэтому проверяются уже после учета всех голосов
+    for user_id, event in events:
+        await check_achievements(user_id, context, event)
+    for user_id in votes:
+        await check_achievements(user_id, context, EVENT_POLL_CLOSED,
+                                 voters=len(votes), yes_votes=yes_votes)
+    
+    # Журнал нужен, пока опрос не попал в снимок: при ошибке записи он остается, и после
+    # рестарта опрос учтется заново (повторный учет отсекает last_closed_poll_id)
+    if await save_data():
+        clear_poll_journal(closed_poll_id)
+    else:
+        logger.warning(f"⚠️ Опрос {closed_poll_id} не сохранен, журнал оставлен до следующей записи")
+        await mark_dirty()
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    username = update.effective_user.username or update.effective_user.first_name
-    usernames[user_id] = username
-    
-    message = update.message
-    
-    # Обработка контента дня (если пользователь был выбран)
-    if user_id in asked_today:
-        await handle_content_submission(update, context)
-        return
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Стикеры и фото в группе и в личке (кроме контента дня) — только счетчики"""
+    user = update.effective_user
+    await remember_username(user)
     
-    # Обычная обработка статистики
-    if message.sticker:
-        stats_stickers[user_id] += 1
-        await check_achievements(user_id, context)
-        await save_data()
-    elif message.photo:
-        stats_photos[user_id] += 1
-        await check_achievements(user_id, context)
-        await save_data()
+    if update.message.sticker:
+        await bump_counter(user.id, context, stats_stickers, EVENT_STICKER)
+    else:
+        await bump_counter(user.id, context, stats_photos, EVENT_PHOTO)
 
 # --- Обработчик ошибок ---
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1424,96 +3129,240 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения об ошибке: {e}")
 
-# --- Основная функция ---
-def main():
-    load_data()
+# --- Остановка бота ---
+# Application.stop() в PTB ждет обработчики, задачи и create_task без ограничения по
+# времени, а post_stop/post_shutdown вызываются уже после него. Поэтому ожидание с
+# дедлайном и запись данных идут сразу по сигналу, до передачи остановки в PTB.
+SHUTDOWN_POLL_INTERVAL = 0.05
+shutdown_state = {"requested": None, "flushed": None}  # perf_counter сигнала и финальной записи
+
+def request_shutdown(application: Application, signame: str):
+    """Сигнал остановки: новые сообщения больше не обрабатываем, дожидаемся текущей работы,
+    сохраняем данные и только потом останавливаем run_polling"""
+    if shutdown_state["requested"] is not None:
+        return
+    shutdown_state["requested"] = perf_counter()
+    logger.info(f"🛑 Получен {signame}: перестаем принимать апдейты и завершаем работу")
+    if not application.running:
+        raise SystemExit
+    asyncio.get_running_loop().create_task(drain_then_stop(application))
+
+async def reject_during_shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Во время остановки сообщения отбрасываем; голоса в опросе принимаем — они сразу пишутся в журнал"""
+    if shutdown_state["requested"] is not None and update.effective_message is not None:
+        inc_counter("updates_rejected_total", reason="shutdown")
+        raise ApplicationHandlerStop
+
+def busy_activities() -> int:
+    """Сколько графиков строится и обработчиков или задач выполняется прямо сейчас"""
+    current = asyncio.current_task()
+    return len(render_inflight) + sum(1 for task in running_activities if task is not current and not task.done())
+
+def sync_poll_journal(close: bool = False):
+    """Сбросить журнал опроса на диск; голоса активного опроса остаются в нем до рестарта"""
+    global poll_journal
+    if poll_journal is None:
+        return
+    poll_journal.flush()
+    os.fsync(poll_journal.fileno())
+    if close:
+        poll_journal.close()
+        poll_journal = None
+
+async def drain_and_flush():
+    """Дождаться графиков и незавершенных обработчиков (до SHUTDOWN_DEADLINE), затем финальная запись"""
+    start = shutdown_state["requested"] or perf_counter()
+    deadline = start + SHUTDOWN_DEADLINE
+    # Обработчики выполняются в задаче, которая живет до Application.stop(),
+    # поэтому ждем не задачи, а пока не останется активной работы
+    pending = busy_activities()
+    if pending:
+        logger.info(f"⏳ Ждем завершения {pending} операций")
+        while busy_activities() and perf_counter() < deadline:
+            await asyncio.sleep(SHUTDOWN_POLL_INTERVAL)
+        not_done = busy_activities()
+        if not_done:
+            inc_counter("shutdown_abandoned_total", not_done)
+            logger.warning(f"⌛ Не дождались {not_done} операций за {SHUTDOWN_DEADLINE} сек")
+    render_pool.shutdown(wait=False, cancel_futures=True)
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    await save_data()
+    sync_poll_journal()
+    shutdown_state["flushed"] = perf_counter()
+    observe("shutdown_drain_seconds", shutdown_state["flushed"] - start)
+    logger.info(f"💾 Данные сохранены через {shutdown_state['flushed'] - start:.2f} сек после сигнала")
+
+async def drain_then_stop(application: Application):
+    """Запись данных до Application.stop(): супервизор может не дождаться его конца"""
+    try:
+        await drain_and_flush()
+    finally:
+        application.stop_running()
+
+# --- Основная функция ---
+async def on_startup(application: Application):
+    await start_metrics_server()
+    start_loop_watchdog(application.bot)
+
+async def on_stop(application: Application):
+    """После Application.stop(): дописать то, что изменилось, пока PTB дожидался обработчиков"""
+    if shutdown_state["flushed"] is None:
+        # Остановка не через наш сигнал (например, исключение в run_polling)
+        await drain_and_flush()
+    else:
+        await flush_dirty()
+    sync_poll_journal(close=True)
+    
+    elapsed = perf_counter() - (shutdown_state["requested"] or shutdown_state["flushed"])
+    poll_text = f", опрос {active_poll_id} продолжится после рестарта" if active_poll_id is not None else ""
+    logger.info(f"✅ Бот остановлен за {elapsed:.2f} сек, данные сохранены{poll_text}")
+
+async def on_shutdown(application: Application):
+    await stop_loop_watchdog()
+    await stop_metrics_server()
+
+def build_application(token: str = None, base_url: str = None, request=None) -> Application:
+    """Сборка приложения со всеми обработчиками и задачами"""
+    application = (
+        Application.builder()
+        .token(token or BOT_TOKEN)
+        .base_url(base_url or TELEGRAM_BASE_URL)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", show_stats))
     application.add_handler(CommandHandler("stats_detailed", show_detailed_stats))
     application.add_handler(CommandHandler("me", show_me))
+    application.add_handler(CommandHandler("charts", set_chart_mode))
     application.add_handler(CommandHandler("top", show_top))
+    application.add_handler(CommandHandler("week", show_week))
     application.add_handler(CommandHandler("help", show_help))
     application.add_handler(CommandHandler("time", check_time))
     application.add_handler(CommandHandler("reset", reset_stats))
     application.add_handler(CommandHandler("test_weekly", test_weekly_summary))
     application.add_handler(CommandHandler("test_content", test_content_system))
     application.add_handler(CommandHandler("jobs", show_scheduled_jobs))
+    application.add_handler(CommandHandler("backfill", backfill_achievement_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("perf", show_perf))
+    application.add_handler(CommandHandler("state", show_state))
+    application.add_handler(CommandHandler("profile", profile_command))
     
-    # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.Regex("^Курить 🚬$"), handle_button))
+    # Обработчики сообщений: сначала дешевые фильтры по типу чата и сообщения,
+    # остальная болтовня ни в один обработчик не попадает
+    application.add_handler(MessageHandler(filters.Text(["Курить 🚬"]), handle_button))
     
+    # Контент дня — только в личке; срабатывает первым, такие стикеры и фото не считаются
     application.add_handler(MessageHandler(
-        filters.TEXT | filters.PHOTO | filters.VIDEO | filters.AUDIO | 
-        filters.Document.ALL | filters.ANIMATION | filters.VOICE | filters.Sticker.ALL, 
-        handle_message
+        filters.ChatType.PRIVATE & AskedTodayFilter() & (
+            (filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.VIDEO | filters.AUDIO |
+            filters.Document.ALL | filters.ANIMATION | filters.VOICE | filters.Sticker.ALL
+        ),
+        handle_content_submission
     ))
     
+    # Стикеры и фото считаются в любом чате, как и раньше
+    application.add_handler(MessageHandler(filters.Sticker.ALL | filters.PHOTO, handle_media))
+    
     # Обработчики опросов
     application.add_handler(PollAnswerHandler(handle_poll_answer))
-    application.add_handler(MessageHandler(filters.POLL, handle_poll_update))
+    application.add_handler(PollHandler(handle_poll_update))
     
+    # Запись трейса для воспроизведения нагрузки
+    if TRACE_FILE:
+        application.add_handler(TypeHandler(Update, record_update), group=-1)
+    
+    instrument_handlers(application)
     application.add_error_handler(error_handler)
     
+    # Отсев апдейтов при остановке — раньше всех групп и без замеров на каждый апдейт
+    application.add_handler(TypeHandler(Update, reject_during_shutdown), group=-2)
+    
     # Планировщик задач
     job_queue = application.job_queue
     
-    # Ежедневный сброс состояния контента в 00:01 ЕКБ (19:01 UTC)
-    job_queue.run_daily(
-        reset_daily_content,
-        time=time(hour=19, minute=1, second=0),
-        days=(0, 1, 2, 3, 4, 5, 6)
+    # Ежедневные задачи по времени ЕКБ, с догонкой пропущенных после рестарта
+    schedule_daily("reset_daily_content", reset_daily_content, 0, 1, EVERY_DAY, grace=20 * 3600)
+    schedule_daily("ask_for_content", ask_for_content, 9, 0, WORKDAYS, grace=45 * 60)
+    schedule_daily("daily_content_reminder", daily_content_reminder, 9, 30, WORKDAYS, grace=20 * 60)
+    schedule_daily("publish_daily_content", publish_daily_content, 10, 0, WORKDAYS, grace=3 * 3600)
+    schedule_daily("friday_rewards", friday_rewards, 17, 0, (4,), grace=6 * 3600)
+    if WEEKLY_DIGEST_DAY:
+        schedule_daily("weekly_digest", weekly_digest, 12, 0, (int(WEEKLY_DIGEST_DAY),), grace=3 * 3600)
+    job_queue.run_once(run_due_jobs, when=1, name="scheduler")
+    
+    # Опрос, восстановленный из журнала, закроется и без апдейта от Telegram
+    if active_poll_id is not None:
+        schedule_poll_close(job_queue)
+    
+    # Отложенная запись счетчиков стикеров и фото
+    schedule_repeating(
+        job_queue,
+        flush_dirty,
+        interval=COUNTER_FLUSH_INTERVAL,
+        first=COUNTER_FLUSH_INTERVAL,
+        name="flush_dirty"
     )
     
-    # Запрос контента в 9:00 ЕКБ (4:00 UTC)
-    job_queue.run_daily(
-        lambda context: asyncio.create_task(ask_for_content(context)),
-        time=time(hour=4, minute=0, second=0),
-        days=(0, 1, 2, 3, 4)
+    # Сохранение данных каждые 5 минут
+    schedule_repeating(
+        job_queue,
+        save_data,
+        interval=300,
+        first=10,
+        name="save_data"
     )
     
-    # Напоминание о контенте в 9:30 ЕКБ (4:30 UTC)
-    job_queue.run_daily(
-        daily_content_reminder,
-        time=time(hour=4, minute=30, second=0),
-        days=(0, 1, 2, 3, 4)
-    )
+    return application
+
+def export_cli(argv: list):
+    """Выгрузка без токена: python perekur2.py export --data-dir DIR.
     
-    # Публикация контента в 10:00 ЕКБ (5:00 UTC)
-    job_queue.run_daily(
-        publish_daily_content,
-        time=time(hour=5, minute=0, second=0),
-        days=(0, 1, 2, 3, 4)
-    )
+    Каталог только читается, поэтому выгрузку можно запускать рядом с работающим
+    ботом: голоса активного опроса в нее не попадают, журнал опроса не трогается.
+    """
+    global DATA_FILE
+    parser = argparse.ArgumentParser(prog="perekur2.py export", description="Выгрузка истории перекуров")
+    parser.add_argument("--data-dir", default=".", help="каталог с bot_data.json")
+    parser.add_argument("--format", choices=sorted(EXPORT_EXTENSIONS), default="csv")
+    parser.add_argument("--out", help="файл выгрузки (по умолчанию perekur_ГГГГММДД.zip/.npz)")
+    args = parser.parse_args(argv)
     
-    # Пятничное награждение в 17:00 ЕКБ (12:00 UTC)
-    job_queue.run_daily(
-        friday_rewards,
-        time=time(hour=12, minute=0, second=0),
-        days=(4,)
-    )
+    DATA_FILE = os.path.join(args.data_dir, os.path.basename(DATA_FILE))
+    load_data(restore_journal=False)
     
-    # Сохранение данных каждые 5 минут
-    job_queue.run_repeating(
-        save_data,
-        interval=300,
-        first=10
-    )
+    out = args.out or f"perekur_{clock.local():%Y%m%d}.{EXPORT_EXTENSIONS[args.format]}"
+    rows = export_data(out, args.format, len(sessions), export_users())
+    print(f"{out}: {os.path.getsize(out)} байт, " + ", ".join(f"{name} {count}" for name, count in rows.items()))
+
+def main():
+    if sys.argv[1:2] == ["export"]:
+        export_cli(sys.argv[2:])
+        return
     
-    # Еженедельное обновление статистики
-    job_queue.run_repeating(
-        update_weekly_stats,
-        interval=3600,
-        first=10
-    )
+    load_data()
+    application = build_application()
+    
+    # Сигналы обрабатываем сами, чтобы до остановки перестать брать новые сообщения.
+    # Где add_signal_handler нет (Windows), остаются сигналы run_polling по умолчанию
+    polling_kwargs = {}
+    loop = asyncio.get_event_loop()
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, request_shutdown, application, sig.name)
+        polling_kwargs["stop_signals"] = None
+    except NotImplementedError:
+        pass
     
     logger.info("Бот запущен")
-    application.run_polling()
+    application.run_polling(**polling_kwargs)
 
 if __name__ == "__main__":
-    import asyncio
     main()
 
@@ -0,0 +1,208 @@
+"""Воспроизведение записанного трейса апдейтов через обработчики бота.
+
+Трейс пишет сам бот, если задан TRACE_FILE (id пользователей анонимизированы).
+Апдейты прогоняются через настоящий Application без сети: ответы Bot API
+отдает FakeTelegram из fake_telegram.py. Время бота при этом симулируется
+по отметкам трейса, так что прогон детерминирован.
+
+Пример:
+    TRACE_FILE=trace.jsonl BOT_TOKEN=... python perekur2.py   # запись
+    python replay.py trace.jsonl --state bot_data.json --speed 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+
+import matplotlib
+matplotlib.use("Agg")
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import perekur2
+from fake_telegram import FakeTelegram, _decode_value
+
+
+class ReplayRequest(BaseRequest):
+    """Транспорт Bot API без сети: запросы обслуживает FakeTelegram в этом же процессе"""
+
+    def __init__(self, fake: FakeTelegram):
+        self.fake = fake
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = {}
+        if request_data is not None:
+            params = {name: _decode_value(value) for name, value in request_data.json_parameters.items()}
+            for name, (_, content, _) in (request_data.multipart_data or {}).items():
+                params[name] = content
+        response = await self.fake.call(url.rsplit("/", 1)[-1], params)
+        return response.get("error_code", 200), json.dumps(response).encode("utf-8")
+
+
+def read_trace(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def snapshot() -> dict:
+    return {
+        "sessions": len(perekur2.sessions),
+        "successful_polls": len(perekur2.successful_polls),
+        "stats_yes": dict(perekur2.stats_yes),
+        "stats_no": dict(perekur2.stats_no),
+        "stats_stickers": dict(perekur2.stats_stickers),
+        "stats_photos": dict(perekur2.stats_photos),
+        "achievements": {uid: set(achs) for uid, achs in perekur2.achievements_unlocked.items()},
+    }
+
+
+def state_diff(before: dict, after: dict) -> dict:
+    """Итоговая разница состояния до и после прогона"""
+    diff = {
+        "sessions": after["sessions"] - before["sessions"],
+        "successful_polls": after["successful_polls"] - before["successful_polls"],
+    }
+    for name in ("stats_yes", "stats_no", "stats_stickers", "stats_photos"):
+        deltas = {
+            uid: value - before[name].get(uid, 0)
+            for uid, value in after[name].items()
+            if value != before[name].get(uid, 0)
+        }
+        diff[name] = {"users_changed": len(deltas), "total_delta": sum(deltas.values())}
+    diff["achievements_granted"] = {
+        str(uid): sorted(perekur2.achievement_names[ach] for ach in achs - before["achievements"].get(uid, set()))
+        for uid, achs in after["achievements"].items()
+        if achs - before["achievements"].get(uid, set())
+    }
+    return diff
+
+
+def build_update(fake: FakeTelegram, event: dict, poll_ids: dict):
+    """Апдейт Bot API для события трейса; None, если событие некуда применить"""
+    kind = event["k"]
+    user_id = event.get("u")
+    chat_id = perekur2.GROUP_CHAT_ID if event.get("c") == "g" else user_id
+
+    if kind in ("answer", "close"):
+        # id опросов при воспроизведении другие — сопоставляем с активным опросом бота
+        poll_id = poll_ids.get(event["p"])
+        if poll_id is None and perekur2.active_poll_id in fake.polls:
+            poll_id = poll_ids[event["p"]] = perekur2.active_poll_id
+        if poll_id is None:
+            return None
+        if kind == "answer":
+            fake.inject_poll_answer(poll_id, user_id, event["o"])
+        else:
+            fake.inject_poll_close(poll_id)
+    elif kind == "button":
+        fake.inject_text(user_id, "Курить 🚬", chat_id)
+    elif kind == "command":
+        fake.inject_text(user_id, event["x"], chat_id)
+    elif kind == "sticker":
+        fake.inject_sticker(user_id, chat_id)
+    elif kind == "photo":
+        fake.inject_photo(user_id, chat_id)
+    else:
+        return None
+    return fake.updates.pop()
+
+
+async def replay(args, events: list, simulated_time: dict) -> dict:
+    fake = FakeTelegram(seed=args.seed)
+    perekur2.METRICS_PORT = 0
+    application = perekur2.build_application(token="123456:REPLAY", request=ReplayRequest(fake))
+    await application.initialize()
+
+    before = snapshot()
+    poll_ids = {}
+    skipped = 0
+    first_t = events[0]["t"] if events else 0
+    wall_start = perf_counter()
+
+    for event in events:
+        if args.speed:
+            delay = (event["t"] - first_t) / args.speed - (perf_counter() - wall_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        simulated_time["t"] = event["t"]
+
+        data = build_update(fake, event, poll_ids)
+        if data is None:
+            skipped += 1
+            continue
+        await application.process_update(Update.de_json(data, application.bot))
+
+    elapsed = perf_counter() - wall_start
+    await application.shutdown()
+
+    handlers = {}
+    for (name, labels), hist in perekur2.metrics_histograms.items():
+        if name == "handler_latency_seconds" and hist[2]:
+            handlers[dict(labels)["handler"]] = {
+                "count": hist[2],
+                "avg_ms": hist[1] / hist[2] * 1000,
+                "p95_ms": perekur2.histogram_quantile(hist, 0.95) * 1000,
+            }
+    saves = sum(hist[2] for (name, _), hist in perekur2.metrics_histograms.items() if name == "save_data_seconds")
+
+    return {
+        "events": len(events),
+        "skipped": skipped,
+        "elapsed_s": elapsed,
+        "handlers": handlers,
+        "persistence": {
+            "save_data_calls": saves,
+            "bytes_written": perekur2.metrics_counters.get(("save_data_bytes_total", ()), 0),
+        },
+        "api_calls": dict(fake.calls),
+        "state_diff": state_diff(before, snapshot()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение трейса апдейтов через обработчики бота")
+    parser.add_argument("trace", help="файл трейса (JSON Lines)")
+    parser.add_argument("--state", help="начальный снимок bot_data.json (копируется, оригинал не меняется)")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 — в реальном темпе, 0 — максимально быстро")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="куда записать отчет JSON")
+    args = parser.parse_args()
+
+    perekur2.logger.setLevel(logging.WARNING)
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+    random.seed(args.seed)
+
+    events = sorted(read_trace(args.trace), key=lambda event: event["t"])
+    simulated_time = {"t": events[0]["t"] if events else 0}
+    perekur2.set_clock(perekur2.Clock(now=lambda: simulated_time["t"]))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        perekur2.DATA_FILE = os.path.join(data_dir, "bot_data.json")
+        perekur2.BACKUP_FILE = os.path.join(data_dir, "bot_data_backup.json")
+        perekur2.POLL_JOURNAL_FILE = os.path.join(data_dir, "poll_journal.jsonl")
+        if args.state:
+            shutil.copyfile(args.state, perekur2.DATA_FILE)
+            perekur2.load_data()
+        report = asyncio.run(replay(args, events, simulated_time))
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())